@@ -1,100 +1,439 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # For the --startup-timing report, before every other import
+
+import os
 import sys
 import csv
-
-from PyQt6.QtCore import QDate
-from PyQt6.QtWidgets import QLabel, QComboBox, QCalendarWidget, QDialog, QApplication, QSpinBox, QVBoxLayout, QHBoxLayout, QMainWindow, QWidget, QMessageBox, QPushButton, QCheckBox
+import json
+import argparse
+import hashlib
+import tempfile
+import threading
+import itertools
+import functools
+import traceback
+import contextlib
+from collections import OrderedDict
+
+import numpy as np
+
+from PyQt6.QtCore import QDate, QTimer, QFileSystemWatcher, Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel, QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt6.QtWidgets import QLabel, QComboBox, QCalendarWidget, QDialog, QApplication, QSpinBox, QVBoxLayout, QHBoxLayout, QMainWindow, QWidget, QMessageBox, QPushButton, QCheckBox, QLineEdit, QListView, QPlainTextEdit, QProgressBar, QFileDialog
 from datetime import datetime
-from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-import matplotlib.dates as mdates
 
-# Matplotlib canvas class
-class MatplotlibCanvas(FigureCanvas):
+IMPORT_FINISHED = time.perf_counter()
+
+DATA_FILE = 'Transformed_Stock_Market_Dataset.csv'
+UNIX_EPOCH_JULIAN_DAY = 2440588  # QDate(1970, 1, 1).toJulianDay()
+NAT_DAY = np.iinfo(np.int64).min  # day key of a date that could not be parsed
+
+class Instrumentation():
+    '''
+    Process-wide timers and counters for the hot paths: data load, price lookup, profit, chart renders and caches.
+    A timed call costs two perf_counter() reads and a dictionary update, so it is always on.
+    '''
+    def __init__(self):
+        self.timers = {}  # name -> [calls, total seconds, max seconds]
+        self.counters = {}
+        self.profilers = None  # --profile makes it a list, one cProfile.Profile per background thread
+        self.local = threading.local()
+
+    def add_time(self, name, seconds):
+        timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def timed(self, name):
+        '''
+        Decorator form of timer.
+        '''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.add_time(name, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    @contextlib.contextmanager
+    def profiled(self):
+        '''
+        Profiles the block when --profile is on. cProfile only sees the thread that enabled it,
+        so the preload and worker threads each enable a profiler of their own, merged by profile_stats.
+        '''
+        profiler = None
+        if self.profilers is not None:
+            profiler = getattr(self.local, 'profiler', None)
+            if profiler is None:
+                import cProfile
+                profiler = self.local.profiler = cProfile.Profile()
+                self.profilers.append(profiler)
+            try:
+                profiler.enable()
+            except ValueError:  # Python 3.12+ profiles every thread from the main profiler, and allows only one
+                profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+    def profile_stats(self, main_profiler):
+        '''
+        :return: pstats.Stats of the main thread profiler and every background thread profiler
+        '''
+        import pstats
+        stats = pstats.Stats(main_profiler, stream=sys.stderr)
+        for profiler in self.profilers or []:
+            if profiler.getstats():  # Never enabled profilers have nothing to add
+                stats.add(profiler)
+        return stats
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        '''
+        :return: dictionary of the timers (calls, total, mean and max seconds) and counters, ready for JSON
+        '''
+        date_cache = StockDataReader.string_date_into_day.cache_info()
+        counters = dict(self.counters, date_parse_cache_hit=date_cache.hits, date_parse_cache_miss=date_cache.misses)
+        timers = {name: {'calls': calls, 'total': total, 'mean': total / calls, 'max': longest}
+                  for name, (calls, total, longest) in sorted(self.timers.items())}
+        return {'timers': timers, 'counters': dict(sorted(counters.items()))}
+
+    def report(self):
+        '''
+        :return: the snapshot as a plain text table
+        '''
+        snapshot = self.snapshot()
+        lines = [f"{'timer':<24}{'calls':>8}{'total ms':>12}{'mean ms':>12}{'max ms':>12}"]
+        for name, timer in snapshot['timers'].items():
+            lines.append(f"{name:<24}{timer['calls']:>8}{timer['total'] * 1000:>12.2f}{timer['mean'] * 1000:>12.3f}{timer['max'] * 1000:>12.2f}")
+        lines.append('')
+        lines.append(f"{'counter':<24}{'value':>8}")
+        for name, value in snapshot['counters'].items():
+            lines.append(f"{name:<24}{value:>8}")
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        with open(path, mode='w') as file:
+            json.dump(self.snapshot(), file, indent=2)
+
+STATS = Instrumentation()
+
+@functools.lru_cache(maxsize=None)
+def load_matplotlib_canvas():
+    '''
+    Imports the matplotlib chart stack and defines MatplotlibCanvas on first use.
+    matplotlib is about half of the import time of this module and charts only appear after Calculate,
+    so the dialog no longer waits for it.
+    :return: the MatplotlibCanvas class
+    '''
+    from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
+    from matplotlib.figure import Figure
+    import matplotlib.dates as mdates
+
+    # Matplotlib canvas class
+    # The artists are created once and then updated in place, redraws go through draw_idle so bursts of updates coalesce
+    class MatplotlibCanvas(FigureCanvas):
+        def __init__(self, parent=None):
+            fig = Figure()
+            self.axes = fig.add_subplot(111)
+            super().__init__(fig)
+            self.setParent(parent)
+            self.bars = {}  # category -> (bar rectangle, value label)
+            self.line = None
+            self.portfolio_lines = None  # (market value, cumulative P&L)
+
+        def draw(self):
+            with STATS.timer('chart_draw'):
+                super().draw()
+
+        @STATS.timed('bar_chart_update')
+        def plot_bar_chart(self, categories, profits, bg_colour='black'): # Method for bar chart
+            if not self.bars:
+                self.axes.set_facecolor(bg_colour)  # Set background color
+                self.axes.set_title('Profit Bar Chart')
+                self.axes.set_xlabel('Categories')
+                self.axes.set_ylabel('Values')
+                self.axes.tick_params(axis='x', labelsize=6) # Font size
+
+            shown = set(categories)
+            for category, (bar, label) in self.bars.items(): # Hide the bars that were unchecked
+                if category not in shown:
+                    bar.set_visible(False)
+                    label.set_visible(False)
+
+            for i, (category, value) in enumerate(zip(categories, profits)):
+                if category not in self.bars: # First time this category is shown
+                    bar = self.axes.bar([i], [0], color='C0')[0]
+                    label = self.axes.text(i, 0, '', ha='center', va='center', color='white', fontweight='bold')
+                    self.bars[category] = (bar, label)
+                bar, label = self.bars[category]
+                ans = round(value, 2)
+                bar.set_x(i - bar.get_width() / 2)
+                bar.set_height(ans)
+                bar.set_visible(True)
+                label.set_position((i, ans / 2)) # Let the text place on the middle of bar
+                label.set_text(f'{ans}')
+                label.set_visible(True)
+
+            self.axes.set_xticks(range(len(categories)))
+            self.axes.set_xticklabels(categories)
+            self.axes.set_xlim(-0.6, len(categories) - 0.4)
+            self.axes.relim(visible_only=True)
+            self.axes.autoscale_view(scalex=False)
+            self.draw_idle()
+
+        @STATS.timed('line_chart_update')
+        def plot_line_graph(self, stockName, dates, prices): # Method for line graph, dates is a datetime64[D] array
+            if self.line is None:
+                self.line, = self.axes.plot(dates, prices, linestyle='-', color='b')
+                self.axes.set_xlabel('Date')
+                self.axes.set_ylabel('Price')
+                self.axes.tick_params(axis='x', labelsize=6) # Font size
+            else:
+                self.line.set_data(dates, prices)
+                self.axes.relim()
+                self.axes.autoscale_view()
+            self.axes.set_title(f"Growth Line Graph of {stockName} per Unit")
+
+            if len(dates) > 10:  # Show only the first and last dates
+                self.axes.set_xticks([dates[0], dates[-1]])
+                self.axes.set_xticklabels([str(dates[0]), str(dates[-1])])  # datetime64[D] prints as YYYY-MM-DD
+            elif len(dates) > 0: # If dates <= 10, show all and format them
+                self.axes.xaxis.set_major_locator(mdates.DayLocator())
+                self.axes.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+
+            self.figure.autofmt_xdate() # Make the date more ez to read
+
+            self.draw_idle()
+
+        @STATS.timed('portfolio_chart_update')
+        def plot_portfolio(self, dates, value, pnl, max_drawdown): # Method for the portfolio simulation, dates is a datetime64[D] array
+            if self.portfolio_lines is None:
+                value_line, = self.axes.plot(dates, value, linestyle='-', color='C0', label='Market value')
+                pnl_line, = self.axes.plot(dates, pnl, linestyle='-', color='C2', label='Cumulative P&L')
+                self.axes.axhline(0, color='grey', linewidth=0.5)
+                self.axes.set_xlabel('Date')
+                self.axes.set_ylabel('Value')
+                self.axes.tick_params(axis='x', labelsize=6) # Font size
+                self.axes.legend(loc='upper left')
+                self.portfolio_lines = (value_line, pnl_line)
+            else:
+                self.portfolio_lines[0].set_data(dates, value)
+                self.portfolio_lines[1].set_data(dates, pnl)
+                self.axes.relim()
+                self.axes.autoscale_view()
+            self.axes.set_title(f"Portfolio, max drawdown {max_drawdown:.2%}")
+
+            self.figure.autofmt_xdate() # Make the date more ez to read
+
+            self.draw_idle()
+
+    globals()['MatplotlibCanvas'] = MatplotlibCanvas
+    return MatplotlibCanvas
+
+def __getattr__(name):
+    # Keeps StockTradeCalculator.MatplotlibCanvas working for importers, loading the chart stack on access
+    if name == 'MatplotlibCanvas':
+        return load_matplotlib_canvas()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def min_max_decimate(x, y, buckets):
+    '''
+    Shrinks a line to at most about 2 * buckets points without changing how it looks:
+    every bucket keeps its lowest and highest point, and the first and last points are always kept.
+    Works on plain arrays, nothing is converted point by point.
+    :return: (x, y) arrays, the inputs themselves if they are already small enough
+    '''
+    count = len(y)
+    buckets = max(int(buckets), 1)
+    if count <= 2 * buckets:
+        return x, y
+
+    size = -(-count // buckets)  # Points per bucket, rounded up
+    buckets = -(-count // size)  # So that no bucket is only padding
+    padded = np.full(buckets * size, np.nan)
+    padded[:count] = y
+    padded = padded.reshape(buckets, size)
+    starts = np.arange(buckets) * size
+    keep = np.concatenate(([0, count - 1], starts + np.nanargmin(padded, axis=1), starts + np.nanargmax(padded, axis=1)))
+    keep = np.unique(keep)  # Sorted, and a bucket whose min and max are the same point keeps it once
+    return x[keep], y[keep]
+
+class TickerListModel(QAbstractListModel):
+    '''
+    Checkable list of stock names for a QListView, which only creates widgets for the rows on screen.
+    '''
+    checkedChanged = pyqtSignal(str, bool)
+
+    def __init__(self, tickers, parent=None):
+        super().__init__(parent)
+        self.tickers = list(tickers)
+        self.checked = {}  # stock -> True, in the order they were checked
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.tickers)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        stock = self.tickers[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return stock
+        if role == Qt.ItemDataRole.CheckStateRole:
+            return Qt.CheckState.Checked if stock in self.checked else Qt.CheckState.Unchecked
+        return None
+
+    def flags(self, index):
+        return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsUserCheckable
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if role != Qt.ItemDataRole.CheckStateRole or not index.isValid():
+            return False
+        self.set_checked(self.tickers[index.row()], Qt.CheckState(value) == Qt.CheckState.Checked)
+        return True
+
+    def set_checked(self, stock, checked):
+        if checked == self.is_checked(stock):
+            return
+        if checked:
+            self.checked[stock] = True
+        else:
+            del self.checked[stock]
+        index = self.index(self.tickers.index(stock))
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.CheckStateRole])
+        self.checkedChanged.emit(stock, checked)
+
+    def is_checked(self, stock):
+        return stock in self.checked
+
+class TickerFilterProxy(QSortFilterProxyModel):
+    '''
+    Filters the ticker list by the search text and hides the stock selected on the calculator.
+    '''
     def __init__(self, parent=None):
-        fig = Figure()
-        self.axes = fig.add_subplot(111)
-        super().__init__(fig)
-        self.setParent(parent)
-
-    def plot_bar_chart(self, categories, profits, bg_colour='black'): # Method for bar chart
-        self.axes.clear()  # Clear previous plot
-        self.axes.set_facecolor(bg_colour)  # Set background color
-        self.axes.bar(categories, profits)
-        self.axes.set_title('Profit Bar Chart')
-        self.axes.set_xlabel('Categories')
-        self.axes.set_ylabel('Values')
-        self.axes.tick_params(axis='x', labelsize=6) # Font size
-        for i, value in enumerate(profits):
-            ans = round(value, 2)
-            self.axes.text(i, ans / 2, f'{ans}', ha='center', va='center', color='white', fontweight='bold') # Let the text place on the middle of bar
-        self.draw()
-
-    def plot_line_graph(self, stockName, dates, prices): # Method for line graph
-        dates = [datetime(year, month, day) for year, month, day in dates]
-
-        self.axes.plot(dates, prices, linestyle='-', color='b')
-        self.axes.set_title(f"Growth Line Graph of {stockName} per Unit")
-        self.axes.set_xlabel('Date')
-        self.axes.set_ylabel('Price')
-
-        if len(dates) > 10:  # Show only the first and last dates
-            self.axes.set_xticks([dates[0], dates[-1]])
-            self.axes.set_xticklabels([dates[0].strftime('%Y-%m-%d'), dates[-1].strftime('%Y-%m-%d')])
-        else: # If dates <= 10, show all and format them
-            self.axes.xaxis.set_major_locator(mdates.DayLocator())
-            self.axes.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-
-        self.figure.autofmt_xdate() # Make the date more ez to read
-
-        self.axes.tick_params(axis='x', labelsize=6) # Font size
-
-        self.draw()
+        super().__init__(parent)
+        self.hidden_stock = None
+        self.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+
+    def set_hidden_stock(self, stock):
+        self.hidden_stock = stock
+        self.invalidateFilter()
 
+    def filterAcceptsRow(self, source_row, source_parent):
+        if self.sourceModel().tickers[source_row] == self.hidden_stock:
+            return False
+        return super().filterAcceptsRow(source_row, source_parent)
 
 class GraphWindow(QMainWindow):
-    def __init__(self, categories, purchase_date_parameter, sell_date_parameter, quantity,bg_colour='black'):
+    def __init__(self, categories, purchase_date_parameter, sell_date_parameter, quantity,bg_colour='black', snap=None, profits=None, stats=None, store=None, runner=None):
         super().__init__()
         self.setWindowTitle("Bar Chart for Comparison")
-        self.setGeometry(200, 200, 600, 400)
+        self.setGeometry(200, 200, 800, 400)
 
-        # Setting up dictionary of Stocks
+        # Setting up the price store, the shared one of DATA_FILE unless the calculator passes its own
         self.data_getter = StockDataReader()
-        self.data = self.data_getter.make_data()
-
-        # Assign variable
-        self.purchase_date = purchase_date_parameter
-        self.sell_date = sell_date_parameter
-        self.amount = quantity
+        self.store = store if store is not None else PriceStore.shared()
+        # Window statistics of stocks that were not prepared are looked up on the calculator's worker thread,
+        # so they never block the window and never run alongside a refresh of the store
+        self.runner = runner if runner is not None else TaskRunner(self)
+        self.bg_colour = bg_colour
         self.category_profit = {}  # Dictionary to hold category and profit
-        self.category_profit[categories] = self.get_price(categories, quantity)
 
         # Layout of graph
         center = QWidget(self)
         self.setCentralWidget(center)
 
-        layout = QVBoxLayout(center)
+        layout = QHBoxLayout(center)
 
-        checkboxes_layout = QHBoxLayout()
+        picker_layout = QVBoxLayout()
 
-        # Add the checkbox except the stock you selected on the calculator
-        for stock_name in self.data.keys():
-            if stock_name != categories:
-                checkbox = QCheckBox(stock_name, self)
-                checkboxes_layout.addWidget(checkbox)  # Add the checkbox to the layout
-                checkbox.stateChanged.connect(self.checkBox_state_changed) # Connect to event
+        # Searchable list of every stock, the one you selected on the calculator is hidden in update_trade
+        self.search_box = QLineEdit(self)
+        self.search_box.setPlaceholderText("Search stocks...")
+        picker_layout.addWidget(self.search_box)
 
-        layout.addLayout(checkboxes_layout)
+        self.ticker_model = TickerListModel(self.store.tickers, self)
+        self.ticker_proxy = TickerFilterProxy(self)
+        self.ticker_proxy.setSourceModel(self.ticker_model)
+        self.ticker_list = QListView(self)
+        self.ticker_list.setModel(self.ticker_proxy)
+        self.ticker_list.setUniformItemSizes(True) # Lets the view skip measuring every row
+        self.ticker_list.setFixedWidth(180)
+        picker_layout.addWidget(self.ticker_list)
 
-        self.canvas = MatplotlibCanvas(self)
-        layout.addWidget(self.canvas)
+        self.search_box.textChanged.connect(self.ticker_proxy.setFilterFixedString)
+        self.ticker_model.checkedChanged.connect(self.checkBox_state_changed) # Connect to event
+
+        layout.addLayout(picker_layout)
 
-        self.update_plot() # Plot the bar chart
+        chart_layout = QVBoxLayout()
+        self.canvas = load_matplotlib_canvas()(self)
+        chart_layout.addWidget(self.canvas)
 
-    def checkBox_state_changed(self):
-        sender = self.sender()  # Get the checkbox that triggered the event
-        category = sender.text()
+        # High, low, return and drawdown of every stock shown, between the two dates
+        self.stats_label = QLabel(self)
+        self.stats_label.setStyleSheet("QLabel { font-family: monospace; }")
+        chart_layout.addWidget(self.stats_label)
+        layout.addLayout(chart_layout)
 
-        if sender.isChecked():
+        self.update_trade(categories, purchase_date_parameter, sell_date_parameter, quantity, snap, profits, stats) # Plot the bar chart
+
+    def update_trade(self, categories, purchase_date_parameter, sell_date_parameter, quantity, snap=None, profits=None, stats=None):
+        '''
+        Shows another trade in the same window, keeping the stocks that are checked.
+        profits is the batch_profit 'profit' array of the trade and stats (stocks, range_stats of them)
+        if they were already calculated, e.g. on a worker thread.
+        '''
+        # Assign variable
+        self.selected_stock = categories
+        self.purchase_date = purchase_date_parameter
+        self.sell_date = sell_date_parameter
+        self.amount = quantity
+        self.snap = snap # Nearest trading day mode, see PriceStore.row_of
+
+        # Profit of every stock at once, so a checkbox toggle only has to redraw
+        if profits is None:
+            purchaseDay = self.data_getter.qdate_into_day(self.purchase_date)
+            sellDay = self.data_getter.qdate_into_day(self.sell_date)
+            profits = self.store.batch_profit(purchaseDay, sellDay, quantity, snap)['profit']
+        self.profits = profits
+
+        # Window statistics, the stocks that were not prepared are looked up on the worker when shown
+        self.purchase_day = self.data_getter.qdate_into_day(self.purchase_date)
+        self.sell_day = self.data_getter.qdate_into_day(self.sell_date)
+        stocks, stats = stats if stats is not None else ([], {})
+        self.stats = {stock: {field: float(values[position]) for field, values in stats.items()} for position, stock in enumerate(stocks)}
+
+        self.ticker_proxy.set_hidden_stock(categories)
+
+        checked = [category for category in self.ticker_model.checked if category != categories]
+        self.category_profit = {categories: self.get_price(categories, quantity)}
+        for category in checked:
+            self.category_profit[category] = self.get_price(category, quantity)
+
+        self.update_plot()
+
+    def checkBox_state_changed(self, category, checked):
+        if checked:
+            if category == self.selected_stock: # The selected stock is always shown
+                return
             self.category_profit[category] = self.get_price(category, self.amount)
             self.update_plot() # Update chart
         else: # Remove the category if the checkbox is unchecked
@@ -103,14 +442,8 @@ class GraphWindow(QMainWindow):
                 self.update_plot() # Update chart
 
     def get_price(self, stock, quantity):
-        # setting up dictionary of Stocks and format the date
-        self.data_reader = StockDataReader()
-        data = self.data_reader.make_data()
-        purchaseDateTuple = self.data_reader.string_date_into_tuple(self.purchase_date.toString('dd-MM-yyyy'))
-        sellDateTuple = self.data_reader.string_date_into_tuple(self.sell_date.toString('dd-MM-yyyy'))
-        self.stock_buy_price = data[stock][purchaseDateTuple]
-        self.stock_sell_price = data[stock][sellDateTuple]
-        total =  self.stock_sell_price * quantity - self.stock_buy_price * quantity
+        # the profits were precomputed for self.amount, scale them if another quantity is asked for
+        total = float(self.profits[self.store.ticker_index[stock]]) * quantity / self.amount
         return total
 
     def update_plot(self):
@@ -118,21 +451,81 @@ class GraphWindow(QMainWindow):
         profits = list(self.category_profit.values())
 
         # Call the plot_bar_chart method in the Canvas class
-        self.canvas.plot_bar_chart(categories, profits, bg_colour='black')
+        self.canvas.plot_bar_chart(categories, profits, bg_colour=self.bg_colour)
+
+        missing = [category for category in categories if category not in self.stats]
+        if missing: # Every stock still missing in one task, a newer one supersedes it
+            self.runner.submit('range_stats', look_up_range_stats, self.store, missing, self.purchase_day, self.sell_day,
+                               on_result=self.stats_found)
+        self.update_stats_label()
+
+    def stats_found(self, result):
+        start_day, end_day, stats = result
+        if (start_day, end_day) != (self.purchase_day, self.sell_day): # Looked up for an earlier trade
+            return
+        self.stats.update(stats)
+        self.update_stats_label()
+
+    def update_stats_label(self):
+        lines = [f"{'':<16}{'High':>12}{'Low':>12}{'Return':>10}{'Drawdown':>10}"]
+        for category in self.category_profit:
+            stats = self.stats.get(category)
+            if stats is None:
+                lines.append(f"{category:<16}{'...':>12}")
+            else:
+                lines.append(f"{category:<16}{stats['high']:>12.2f}{stats['low']:>12.2f}{stats['percent_return']:>9.2f}%{stats['max_drawdown']:>9.2f}%")
+        self.stats_label.setText('\n'.join(lines))
 
 class LineGraphWindow(QMainWindow):
-    def __init__(self, stock_name_parameter, purchase_date_parameter, sell_date_parameter):
+    def __init__(self, stock_name_parameter, purchase_date_parameter, sell_date_parameter, series=None, store=None):
         super().__init__()
         self.setWindowTitle("Line Graph for Stock Growth")
         self.setGeometry(100, 100, 600, 400)
 
-        # Setting up dictionary of Stocks
-        self.data_getter = StockDataReader()
-        self.data = self.data_getter.make_data()
+        # Setting up the price store, the shared one of DATA_FILE unless the calculator passes its own
+        self.store = store if store is not None else PriceStore.shared()
+
+        widget = QWidget()
+        self.setCentralWidget(widget)
+
+        layout = QVBoxLayout()
+        widget.setLayout(layout)
+
+        self.canvas = load_matplotlib_canvas()(self)
+        layout.addWidget(self.canvas)
+
+        self.update_range(stock_name_parameter, purchase_date_parameter, sell_date_parameter, series)
 
-        # Assign value
-        dates = []
-        prices = []
+    def update_range(self, stock_name_parameter, purchase_date_parameter, sell_date_parameter, series=None):
+        '''
+        Shows another stock or range in the same window.
+        series is the (dates, prices) of the range if it was already sliced, e.g. on a worker thread.
+        '''
+        # Slice the data in between the range, the parameters are integer day keys
+        self.stock_name = stock_name_parameter
+        if series is None:
+            self.store = PriceStore.shared(self.store.path)
+            series = self.store.range_series(stock_name_parameter, purchase_date_parameter, sell_date_parameter)
+        self.dates, self.prices = series
+        self.plot_series()
+
+    def plot_series(self):
+        # Plot the data, decimated to one bucket per pixel of width so long ranges cost the same as short ones
+        # (the window width is used because the canvas has no size of its own before the window is shown)
+        self.plotted_width = self.width()
+        dates, prices = min_max_decimate(self.dates, self.prices, self.plotted_width)
+        self.canvas.plot_line_graph(self.stock_name, dates, prices)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if hasattr(self, 'dates') and self.width() != self.plotted_width and len(self.dates) > 2 * min(self.width(), self.plotted_width):
+            self.plot_series()  # The line was decimated for another width
+
+class PortfolioWindow(QMainWindow):
+    def __init__(self, result):
+        super().__init__()
+        self.setWindowTitle("Portfolio Simulation")
+        self.setGeometry(150, 150, 800, 450)
 
         widget = QWidget()
         self.setCentralWidget(widget)
@@ -140,18 +533,190 @@ class LineGraphWindow(QMainWindow):
         layout = QVBoxLayout()
         widget.setLayout(layout)
 
-        self.canvas = MatplotlibCanvas(self)
+        self.summary = QLabel()
+        layout.addWidget(self.summary)
+
+        self.canvas = load_matplotlib_canvas()(self)
         layout.addWidget(self.canvas)
 
-        # Filter the data in between the range
-        price_per_unit = {date: price for date, price in self.data[stock_name_parameter].items() if purchase_date_parameter <= date <= sell_date_parameter}
+        self.update_result(result)
 
-        for date, price in price_per_unit.items():
-            dates.append(date)
-            prices.append(price)
+    def update_result(self, result):
+        '''
+        Shows another simulation in the same window.
+        '''
+        self.result = result
+        final_pnl = result['pnl'][-1] if len(result['pnl']) else 0.0
+        final_return = result['cumulative_return'][-1] if len(result['cumulative_return']) else 0.0
+        self.summary.setText(f"Positions: {result['positions']} ({result['skipped']} skipped)   P&L: ${final_pnl:,.2f}   "
+                             f"Return: {final_return:.2%}   Max drawdown: {result['max_drawdown']:.2%}")
+        self.canvas.plot_portfolio(result['dates'], result['value'], result['pnl'], result['max_drawdown'])
+
+class StatsDialog(QDialog):
+    '''
+    Shows the timers and counters of STATS.
+    '''
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Stats")
+        self.resize(560, 420)
+
+        layout = QVBoxLayout(self)
+        self.text = QPlainTextEdit(self)
+        self.text.setReadOnly(True)
+        self.text.setStyleSheet("QPlainTextEdit { font-family: monospace; }")
+        layout.addWidget(self.text)
+
+        self.refresh_button = QPushButton("Refresh")
+        self.refresh_button.clicked.connect(self.refresh)
+        layout.addWidget(self.refresh_button)
+
+    def refresh(self):
+        self.text.setPlainText(STATS.report())
 
-        # Plot the data
-        self.canvas.plot_line_graph(stock_name_parameter, dates, prices)
+class Task(QRunnable):
+    '''
+    One call of function(*args) on the TaskRunner's thread pool.
+    '''
+    def __init__(self, runner, channel, function, args, on_result, on_error):
+        super().__init__()
+        self.setAutoDelete(False)  # The runner keeps it, and tryTake may still be called on it
+        self.runner = runner
+        self.channel = channel
+        self.function = function
+        self.args = args
+        self.on_result = on_result
+        self.on_error = on_error
+        self.cancelled = False
+
+    def run(self):
+        result = error = None
+        if not self.cancelled:  # Superseded while it was waiting
+            try:
+                with STATS.profiled():
+                    result = self.function(*self.args)
+            except Exception:
+                error = traceback.format_exc()
+        self.runner.taskDone.emit(self, result, error)
+
+class TaskRunner(QObject):
+    '''
+    Runs the store work of a window off the GUI thread and hands the results back to it.
+    Every task belongs to a channel ('lookup', 'calculate', ...) and a new task supersedes the previous one of its channel:
+    it is taken off the queue if it has not started, and its result is dropped if it has.
+    One worker thread, so a refresh of the store never runs alongside a lookup in it.
+    '''
+    taskDone = pyqtSignal(object, object, object)  # task, result, error traceback
+    busyChanged = pyqtSignal(bool)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.latest = {}  # channel -> its newest Task
+        self.pending = set()
+        self.taskDone.connect(self.deliver, Qt.ConnectionType.QueuedConnection)  # Emitted on the worker thread
+
+    def submit(self, channel, function, *args, on_result=None, on_error=None):
+        previous = self.latest.get(channel)
+        if previous is not None:
+            previous.cancelled = True
+            if self.pool.tryTake(previous):
+                self.pending.discard(previous)
+                STATS.count('tasks_cancelled')
+        task = Task(self, channel, function, args, on_result, on_error)
+        self.latest[channel] = task
+        self.pending.add(task)
+        self.pool.start(task)
+        if len(self.pending) == 1:
+            self.busyChanged.emit(True)
+        return task
+
+    def deliver(self, task, result, error):
+        self.pending.discard(task)
+        if self.latest.get(task.channel) is task:
+            del self.latest[task.channel]
+            if error is not None:
+                STATS.count('errors')
+                print(f"Error in {task.channel}:\n{error}", file=sys.stderr)
+                if task.on_error is not None:
+                    task.on_error(error)
+            elif task.on_result is not None:
+                task.on_result(result)
+        else:
+            STATS.count('tasks_superseded')
+        if not self.pending:
+            self.busyChanged.emit(False)
+
+    def is_busy(self):
+        return bool(self.pending)
+
+    def wait_for_done(self):
+        '''
+        Blocks until every submitted task has run and its result was delivered; for scripts and headless use.
+        '''
+        while self.pending:
+            self.pool.waitForDone()
+            QApplication.processEvents()
+
+@STATS.timed('price_lookup')
+def look_up_trade(store, stock, purchase_day, sell_day, snap=None):
+    '''
+    Looks the purchase and sell prices of a trade up. Runs on the worker thread, so it must not touch any widget.
+    :return: dictionary with the arguments and, for 'purchase' and 'sell', (price, trading day used) or None if there is no price
+    '''
+    trade = {'stock': stock, 'purchase_day': purchase_day, 'sell_day': sell_day}
+    for side, day in (('purchase', purchase_day), ('sell', sell_day)):
+        if store.has_price(stock, day, snap):
+            trade[side] = (store.price(stock, day, snap), store.trading_day(day, snap))
+        else:
+            trade[side] = None
+    return trade
+
+@STATS.timed('calculate')
+def prepare_trade(store, stock, purchase_day, sell_day, quantity, snap=None):
+    '''
+    Everything the Calculate button shows, on the worker thread: the price lookup, the totals of every stock
+    (the bar chart needs them all), the price series of the line graph and the high / low / return / drawdown of the window.
+    :return: the look_up_trade dictionary, with 'totals', 'series', 'range_stocks' and 'range_stats' when both prices were found
+    '''
+    trade = look_up_trade(store, stock, purchase_day, sell_day, snap)
+    trade['quantity'] = quantity
+    if trade['purchase'] is not None and trade['sell'] is not None:
+        trade['totals'] = store.batch_profit(purchase_day, sell_day, quantity, snap)
+        trade['series'] = store.range_series(stock, purchase_day, sell_day)
+        # Window statistics of every stock when the store has them all indexed, else of the selected one
+        trade['range_stocks'] = store.tickers if store.range_index is not None else [stock]
+        trade['range_stats'] = store.range_stats(purchase_day, sell_day, None if store.range_index is not None else [stock])
+    return trade
+
+def look_up_range_stats(store, stocks, start_day, end_day):
+    '''
+    High, low, return and drawdown of some stocks between two day keys, on the worker thread.
+    :return: (start_day, end_day, {stock: {field: value}})
+    '''
+    stats = store.range_stats(start_day, end_day, stocks)
+    return start_day, end_day, {stock: {field: float(values[position]) for field, values in stats.items()}
+                                for position, stock in enumerate(stocks)}
+
+def load_store(path=DATA_FILE):
+    '''
+    PriceStore.shared for the window: the store prints a failed load and comes up empty, which is raised here
+    so that it reaches the on_error of the task.
+    :return: the shared store of path
+    '''
+    store = PriceStore.shared(path)
+    if store.signature is None or not store.tickers or not len(store.days):
+        raise ValueError(f"no price data could be loaded from {path}")
+    return store
+
+def refresh_store(path=DATA_FILE):
+    '''
+    :return: True if the shared store of path changed
+    '''
+    with PriceStore._shared_lock:
+        store = PriceStore._shared.get(path)
+        return store is None or store.refresh()
 
 class StockTradeProfitCalculator(QDialog):
     '''
@@ -166,16 +731,19 @@ class StockTradeProfitCalculator(QDialog):
     - Displays the profit total
     '''
 
-    def __init__(self):
+    def __init__(self, data_path=DATA_FILE):
         '''
         This method requires substantial updates.
         Each of the widgets should be suitably initialized and laid out.
+        The data is loaded on a worker thread; the controls are enabled in data_loaded.
         '''
         super().__init__()
 
-        # setting up dictionary of Stocks
+        # setting up the worker thread, the shared price store is loaded on it
         self.data_reader = StockDataReader()
-        self.data = self.data_reader.make_data()
+        self.data_path = data_path
+        self.store = None
+        self.runner = TaskRunner(self)
 
         # TODO: initialize the layout - 6 rows to start
         # Initialize the layout
@@ -189,6 +757,17 @@ class StockTradeProfitCalculator(QDialog):
         self.stock_sell_price = 0
         self.purchase_active = False
         self.sell_active = False
+        self.stock_name = ''
+        self.sellDate = QDate.currentDate()  # Until the data is loaded
+        self.purchaseDate = QDate.currentDate()
+
+        # Busy indicator while the worker thread loads or calculates
+        self.busy_indicator = QProgressBar()
+        self.busy_indicator.setRange(0, 0)
+        self.busy_indicator.setTextVisible(False)
+        self.busy_indicator.setMaximumHeight(6)
+        layout.addWidget(self.busy_indicator)
+        self.runner.busyChanged.connect(self.busy_indicator.setVisible)
 
         # TODO: create QLabel for Stock selection
         # Stock selection label
@@ -196,24 +775,9 @@ class StockTradeProfitCalculator(QDialog):
         layout.addWidget(self.stock_label)
 
         # TODO: create QComboBox and populate it with a list of Stocks
-        # Stock selection ComboBox
+        # Stock selection ComboBox, filled in data_loaded
         self.stock_combobox = QComboBox()
-        self.stock_combobox.addItems(self.data.keys())
         layout.addWidget(self.stock_combobox)
-        self.stock_name = self.stock_combobox.currentText()
-
-        # TODO: Define buyCalendarDefaultDate
-        # Check if current stock exists, if not, handle it gracefully
-        if self.stock_name in self.data:
-            self.sellDefaultDate = list(self.data[self.stock_name].keys())[0]
-            self.purchaseDefaultDate = list(self.data[self.stock_name].keys())[1]
-            self.sellDate = QDate(self.sellDefaultDate[0],self.sellDefaultDate[1],self.sellDefaultDate[2]) # Tuple convert to datetime obj
-            self.purchaseDate = QDate(self.purchaseDefaultDate[0], self.purchaseDefaultDate[1],self.purchaseDefaultDate[2])  # Tuple convert to datetime obj
-            print(f'{self.sellDate}, {self.purchaseDate}')
-        else:
-            print("Current stock not found in the dataset. Available stocks:", self.data.keys())
-            self.sellDate = QDate.currentDate()  # Default to the current date
-            self.purchaseDate = QDate.currentDate()
 
         # TODO: create QLabel for Quantity selection
         # Quantity selection label
@@ -227,8 +791,12 @@ class StockTradeProfitCalculator(QDialog):
         self.quantity_spinbox.setMaximum(10000)
         layout.addWidget(self.quantity_spinbox)
 
+        # Use the previous trading day when a weekend or holiday is selected
+        self.snap_checkbox = QCheckBox("Use previous trading day when the market is closed")
+        layout.addWidget(self.snap_checkbox)
+
         #  status of data browse
-        self.purchase_date_status = QLabel()
+        self.purchase_date_status = QLabel("Loading data...")
         layout.addWidget(self.purchase_date_status)
 
         # TODO: create CalendarWidgets for selection of purchase and sell dates
@@ -276,25 +844,90 @@ class StockTradeProfitCalculator(QDialog):
         self.stock_profit_total = QLabel(f"Profit :${self.total_profit:.2f}")
         layout.addWidget(self.stock_profit_total)
 
+        # Statistics of the selected stock between the two dates
+        sub3_layout = QHBoxLayout()
+        self.stock_period_high = QLabel("Period High :$0.00")
+        self.stock_period_low = QLabel("Period Low :$0.00")
+        self.stock_period_return = QLabel("Return :0.00%")
+        self.stock_max_drawdown = QLabel("Max Drawdown :0.00%")
+        for label in (self.stock_period_high, self.stock_period_low, self.stock_period_return, self.stock_max_drawdown):
+            sub3_layout.addWidget(label)
+        sub3_layout.addStretch(1)
+        layout.addLayout(sub3_layout)
+
         # A button to confirm your selection
         self.confirm_button = QPushButton("Calculate")
         layout.addWidget(self.confirm_button)
 
-        # Initialize the UI
-        self.updateCalendarUi()
+        # A button to search the best buy and sell dates between the selected dates
+        self.best_trade_button = QPushButton("Find Best Trade")
+        layout.addWidget(self.best_trade_button)
+
+        # A button to simulate a whole book of positions from a file
+        self.portfolio_button = QPushButton("Simulate Portfolio...")
+        layout.addWidget(self.portfolio_button)
+
+        # A button to see where the time goes
+        self.stats_button = QPushButton("Show Stats")
+        layout.addWidget(self.stats_button)
+
+        # Controls that need the data, disabled until it is loaded
+        self.data_widgets = [self.stock_combobox, self.quantity_spinbox, self.snap_checkbox, self.purchase_calendar,
+                             self.sell_calendar, self.confirm_button, self.best_trade_button, self.portfolio_button]
+        for widget in self.data_widgets:
+            widget.setEnabled(False)
+
+        # Calendar clicks are debounced: the lookup runs once the clicking has stopped for a moment
+        self.lookup_timer = QTimer(self)
+        self.lookup_timer.setSingleShot(True)
+        self.lookup_timer.setInterval(150)
+        self.lookup_timer.timeout.connect(self.updateCalendarUi)
 
         # TODO: connecting signals to slots so that a change in one control updates the UI
         self.confirm_button.clicked.connect(self.updateUi)
-        self.purchase_calendar.clicked.connect(self.updateCalendarUi)
-        self.sell_calendar.clicked.connect(self.updateCalendarUi)
+        self.best_trade_button.clicked.connect(self.find_best_trade)
+        self.portfolio_button.clicked.connect(self.simulate_portfolio)
+        self.stats_button.clicked.connect(self.show_stats)
+        self.purchase_calendar.clicked.connect(self.lookup_timer.start)
+        self.sell_calendar.clicked.connect(self.lookup_timer.start)
+        self.snap_checkbox.stateChanged.connect(self.lookup_timer.start)
 
         # TODO: set the window title
         self.setLayout(layout)
         self.setWindowTitle('Stock Trade Profit Calculator')
+        self.runner.submit('load', load_store, self.data_path, on_result=self.data_loaded, on_error=self.data_load_failed)
         self.show()
 
+    def data_loaded(self, store):
+        # Initialize the UI with the loaded data
+        self.store = store
+        self.stock_combobox.addItems(self.store.tickers)
+        self.stock_name = self.stock_combobox.currentText()
+
+        # TODO: Define buyCalendarDefaultDate
+        # Check if current stock exists, if not, handle it gracefully
+        if self.stock_name in self.store.ticker_index and len(self.store.dates) > 1:
+            self.sellDefaultDate = int(self.store.days[-1]) # Latest trading day
+            self.purchaseDefaultDate = int(self.store.days[-2])
+            self.sellDate = self.data_reader.day_into_qdate(self.sellDefaultDate) # Day key convert to QDate
+            self.purchaseDate = self.data_reader.day_into_qdate(self.purchaseDefaultDate)  # Day key convert to QDate
+            print(f'{self.sellDate}, {self.purchaseDate}')
+        else:
+            print("Current stock not found in the dataset. Available stocks:", self.store.tickers)
+
+        self.purchase_calendar.setSelectedDate(self.purchaseDate)
+        self.sell_calendar.setSelectedDate(self.sellDate)
+        for widget in self.data_widgets:
+            widget.setEnabled(True)
+        self.updateCalendarUi()
+
+    def data_load_failed(self, error):
+        self.purchase_date_status.setText("Could not load the data")
+        self.purchase_date_status.setStyleSheet("QLabel { color : red; }")
+
     def updateCalendarUi(self):
         # TODO: get selected dates from calendars
+        self.lookup_timer.stop()
         self.selected_purchase_date = self.purchase_calendar.selectedDate()
         self.selected_sell_date = self.sell_calendar.selectedDate()
 
@@ -321,42 +954,139 @@ class StockTradeProfitCalculator(QDialog):
         '''
         This requires substantial development.
         Updates the UI when control values are changed; should also be called when the app initializes.
+        The totals and chart data are prepared on the worker thread and shown by trade_calculated.
         '''
-        # Setting up data class
-        self.tuple_convertor = StockDataReader()
-
-        try:
-            if self.quantity_spinbox.value() <= 0: # Validation for quantity
-                self.error_msg = "Stock quantity must greater than 0"
-                self.show_error_message()
-
-            elif self.purchase_active and self.sell_active: # Both data found
-                self.get_price()
+        if self.store is None: # Still loading
+            return
+        if self.lookup_timer.isActive(): # A calendar click is still being debounced, take it into account first
+            self.updateCalendarUi()
 
-                # TODO: perform necessary calculations to calculate totals
-                self.purchase_total_price = self.stock_buy_price  * self.quantity_spinbox.value() # purchase total price
-                self.sell_total_price = self.stock_sell_price * self.quantity_spinbox.value() # sell total price
-                self.total_profit = self.sell_total_price - self.purchase_total_price #total profit
-
-                # TODO: update the label displaying totals
-                self.stock_purchase_total.setText(f"Purchase Total: $ {self.purchase_total_price:.2f}") #render label of purchase total
-                self.stock_sell_total.setText(f"Sell Total :${self.sell_total_price:.2f}")  # render label of sell total
-                self.stock_profit_total.setText(f"Profit :${self.total_profit:.2f}") # render label of total profit
+        if self.quantity_spinbox.value() <= 0: # Validation for quantity
+            self.error_msg = "Stock quantity must greater than 0"
+            self.show_error_message()
+            return
 
-                purchaseDateTuple = self.tuple_convertor.string_date_into_tuple(self.purchaseDate.toString('dd-MM-yyyy'))
-                sellDateTuple = self.tuple_convertor.string_date_into_tuple(self.sellDate.toString('dd-MM-yyyy'))
-                self.show_line_graph(purchaseDateTuple, sellDateTuple)
-                self.show_graph()
+        # TODO: perform necessary calculations to calculate totals
+        self.stock_name = self.stock_combobox.currentText()
+        purchaseDay = self.data_reader.qdate_into_day(self.purchaseDate)
+        sellDay = self.data_reader.qdate_into_day(self.sellDate)
+        self.runner.submit('calculate', prepare_trade, self.store, self.stock_name, purchaseDay, sellDay,
+                           self.quantity_spinbox.value(), self.snap_mode(), on_result=self.trade_calculated)
 
-            else:
+    def trade_calculated(self, trade):
+        try:
+            self.prices_found(trade)
+            if 'totals' not in trade: # Not both data found
                 self.error_msg = "Please select a date that contain data"
                 self.show_error_message()
                 self.purchase_calendar.setSelectedDate(self.purchaseDate)  # to recover the calendar
                 self.sell_calendar.setSelectedDate(self.sellDate)
-
-            pass  # placeholder for future code
+                return
+
+            totals = trade['totals']
+            column = self.store.ticker_index[trade['stock']]
+            self.purchase_total_price = float(totals['purchase_total'][column]) # purchase total price
+            self.sell_total_price = float(totals['sell_total'][column]) # sell total price
+            self.total_profit = float(totals['profit'][column]) #total profit
+
+            # TODO: update the label displaying totals
+            self.stock_purchase_total.setText(f"Purchase Total: $ {self.purchase_total_price:.2f}") #render label of purchase total
+            self.stock_sell_total.setText(f"Sell Total :${self.sell_total_price:.2f}")  # render label of sell total
+            self.stock_profit_total.setText(f"Profit :${self.total_profit:.2f}") # render label of total profit
+
+            # render labels of the window statistics
+            stats = trade['range_stats']
+            position = trade['range_stocks'].index(trade['stock'])
+            self.stock_period_high.setText(f"Period High :${stats['high'][position]:.2f}")
+            self.stock_period_low.setText(f"Period Low :${stats['low'][position]:.2f}")
+            self.stock_period_return.setText(f"Return :{stats['percent_return'][position]:.2f}%")
+            self.stock_max_drawdown.setText(f"Max Drawdown :{stats['max_drawdown'][position]:.2f}%")
+
+            self.show_line_graph(trade['purchase_day'], trade['sell_day'], trade['series'])
+            self.show_graph(trade)
         except Exception as e:
+            STATS.count('errors')
             print(f"Error in updateUi: {e}")
+            traceback.print_exc()
+
+    def watch_data_file(self):
+        '''
+        Refreshes the dialog and the open charts when rows are added to the CSV.
+        '''
+        self.file_watcher = QFileSystemWatcher([self.data_path], self)
+        self.file_watcher.fileChanged.connect(self.data_file_changed)
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(300)
+        self.refresh_timer.timeout.connect(self.refresh_data)
+
+    def data_file_changed(self, path):
+        if path not in self.file_watcher.files(): # A file replaced by a rename drops out of the watch
+            self.file_watcher.addPath(path)
+        self.refresh_timer.start() # Feeds write in bursts, wait until it settles
+
+    def refresh_data(self):
+        if self.store is None: # The first load will read the new rows
+            return
+        self.runner.submit('refresh', refresh_store, self.data_path, on_result=self.data_refreshed)
+
+    def data_refreshed(self, changed):
+        if not changed:
+            return
+        self.updateCalendarUi()
+        charts_open = any(window is not None and window.isVisible() for window in (getattr(self, 'graph_window', None), getattr(self, 'line_graph_window', None)))
+        if charts_open:
+            self.updateUi()
+
+    def find_best_trade(self):
+        '''
+        Moves both calendars to the most profitable buy and sell dates of the selected stock between the selected dates.
+        '''
+        if self.lookup_timer.isActive(): # Search between the dates just clicked
+            self.updateCalendarUi()
+        self.stock_name = self.stock_combobox.currentText()
+        purchaseDay = self.data_reader.qdate_into_day(self.purchaseDate)
+        sellDay = self.data_reader.qdate_into_day(self.sellDate)
+        self.runner.submit('best_trade', self.store.best_trades, purchaseDay, sellDay,
+                           on_result=functools.partial(self.best_trade_found, self.stock_name))
+
+    def best_trade_found(self, stock, trades):
+        column = self.store.ticker_index[stock]
+
+        if not trades['profit'][0, column] > 0: # nan or no gain
+            self.error_msg = "No profitable trade found between the selected dates"
+            self.show_error_message()
+            return
+
+        self.purchase_calendar.setSelectedDate(self.data_reader.day_into_qdate(trades['buy_day'][0, column]))
+        self.sell_calendar.setSelectedDate(self.data_reader.day_into_qdate(trades['sell_day'][0, column]))
+        self.updateCalendarUi()
+
+    def simulate_portfolio(self):
+        '''
+        Asks for a positions file (the batch scenario format) and simulates it on the worker thread.
+        '''
+        path, _ = QFileDialog.getOpenFileName(self, "Open Positions", "", "Positions (*.csv *.jsonl)")
+        if path:
+            self.runner.submit('portfolio', simulate_portfolio_file, self.store, path, self.snap_mode(),
+                               on_result=self.show_portfolio, on_error=self.portfolio_failed)
+
+    def portfolio_failed(self, error):
+        self.error_msg = "Could not simulate the positions file, see the console for details"
+        self.show_error_message()
+
+    def show_portfolio(self, result): # Create and show the portfolio window
+        if getattr(self, 'portfolio_window', None) is None:
+            self.portfolio_window = PortfolioWindow(result)
+        else: # Reuse the window, only the lines change
+            self.portfolio_window.update_result(result)
+        self.portfolio_window.show()
+
+    def show_stats(self): # Create and show the stats window
+        if getattr(self, 'stats_dialog', None) is None:
+            self.stats_dialog = StatsDialog(self)
+        self.stats_dialog.refresh()
+        self.stats_dialog.show()
 
     def show_error_message(self): # Pop up an error message
         error = QMessageBox()
@@ -367,27 +1097,47 @@ class StockTradeProfitCalculator(QDialog):
         error.setStandardButtons(QMessageBox.StandardButton.Ok)
         error.exec()
 
-    def show_graph(self): # Create and show the graph window
-        self.quantity = self.quantity_spinbox.value()
-        self.graph_window = GraphWindow(self.stock_name, self.purchaseDate, self.sellDate, self.quantity)
+    def show_graph(self, trade): # Create and show the graph window, with the profits prepared on the worker thread
+        self.quantity = trade['quantity']
+        purchaseDate = self.data_reader.day_into_qdate(trade['purchase_day'])
+        sellDate = self.data_reader.day_into_qdate(trade['sell_day'])
+        profits = trade['totals']['profit']
+        stats = (trade['range_stocks'], trade['range_stats'])
+        if getattr(self, 'graph_window', None) is None:
+            self.graph_window = GraphWindow(trade['stock'], purchaseDate, sellDate, self.quantity, snap=self.snap_mode(), profits=profits, stats=stats, store=self.store, runner=self.runner)
+        else: # Reuse the window, only the bars change
+            self.graph_window.update_trade(trade['stock'], purchaseDate, sellDate, self.quantity, snap=self.snap_mode(), profits=profits, stats=stats)
         self.graph_window.show()
 
-    def show_line_graph(self, purchase_date, sell_date): # Create and show the line graph
-        self.line_graph_window = LineGraphWindow(self.stock_name, purchase_date, sell_date)
+    def show_line_graph(self, purchase_date, sell_date, series=None): # Create and show the line graph
+        if getattr(self, 'line_graph_window', None) is None:
+            self.line_graph_window = LineGraphWindow(self.stock_name, purchase_date, sell_date, series, store=self.store)
+        else: # Reuse the window, only the line changes
+            self.line_graph_window.update_range(self.stock_name, purchase_date, sell_date, series)
         self.line_graph_window.show()
 
+    def snap_mode(self):
+        return 'previous' if self.snap_checkbox.isChecked() else None
+
+    def found_status_text(self, day, trading_day):
+        if trading_day == day:
+            return "Data found"
+        return f"Data found (using {self.data_reader.day_into_qdate(trading_day).toString('dd-MM-yyyy')})"
+
     def get_price(self):
-        # setting up dictionary of Stocks and format the date
-        self.data_reader = StockDataReader()
-        data = self.data_reader.make_data()
+        # format the date and look the prices up on the worker thread, prices_found shows them
         self.stock_name = self.stock_combobox.currentText()
-        purchaseDateTuple = self.data_reader.string_date_into_tuple(self.selected_purchase_date.toString('dd-MM-yyyy'))
-        sellDateTuple = self.data_reader.string_date_into_tuple(self.selected_sell_date.toString('dd-MM-yyyy'))
+        purchaseDay = self.data_reader.qdate_into_day(self.selected_purchase_date)
+        sellDay = self.data_reader.qdate_into_day(self.selected_sell_date)
+        self.purchase_active = self.sell_active = False # Until the lookup answers
+        self.runner.submit('lookup', look_up_trade, self.store, self.stock_name, purchaseDay, sellDay, self.snap_mode(),
+                           on_result=self.prices_found)
 
+    def prices_found(self, trade):
         # Retrieve the stock price for the purchase date
-        if self.stock_name in data and purchaseDateTuple in data[self.stock_name]:
-            self.stock_buy_price = data[self.stock_name][purchaseDateTuple]
-            self.purchase_date_status.setText("Data found")
+        if trade['purchase'] is not None:
+            self.stock_buy_price, trading_day = trade['purchase']
+            self.purchase_date_status.setText(self.found_status_text(trade['purchase_day'], trading_day))
             self.purchase_date_status.setStyleSheet("QLabel { color : green; }")
             self.purchase_active = True
         else:
@@ -397,9 +1147,9 @@ class StockTradeProfitCalculator(QDialog):
             self.purchase_date_status.setStyleSheet("QLabel { color : red; }")
 
         # Retrieve the stock price for the sell date
-        if self.stock_name in data and sellDateTuple in data[self.stock_name]:
-            self.stock_sell_price = data[self.stock_name][sellDateTuple]
-            self.sell_date_status.setText("Data found")
+        if trade['sell'] is not None:
+            self.stock_sell_price, trading_day = trade['sell']
+            self.sell_date_status.setText(self.found_status_text(trade['sell_day'], trading_day))
             self.sell_date_status.setStyleSheet("QLabel { color : green; }")
             self.sell_active = True
         else:
@@ -409,40 +1159,28 @@ class StockTradeProfitCalculator(QDialog):
             self.sell_date_status.setStyleSheet("QLabel { color : red; }")
 
 class StockDataReader():
-    def make_data(self):
+    def make_data(self, path=DATA_FILE):
         '''
-        This code reads the stock market CSV file and generates a dictionary structure.
+        This code builds the old dictionary structure from the shared PriceStore.
         :return: a dictionary of dictionaries
         '''
+        store = PriceStore.shared(path)
+        date_tuples = [(date.year, date.month, date.day) for date in store.dates.tolist()]
         data = {}
-        try:
-            with open('Transformed_Stock_Market_Dataset.csv', mode='r') as file:
-                reader = csv.DictReader(file)
-                stock_names = reader.fieldnames[1:]  # All columns except 'Date' are stock names
-
-                for row in reader:
-                    date_string = row['Date']
-                    date_tuple = self.string_date_into_tuple(date_string)
-
-                    for stock in stock_names:
-                        price = row[stock].replace(',', '')
-                        try:
-                            price = float(price)
-                        except ValueError:
-                            price = 0.0
-
-                        if stock not in data:
-                            data[stock] = {}
-
-                        data[stock][date_tuple] = price
-
-            print("Data loaded successfully.")
-            print(f"Stocks available: {stock_names}")  # Debugging: Print all available stock names
-
-        except Exception as e:
-            print(f"Error reading data: {e}")
+        for stock in store.tickers:
+            data[stock] = dict(zip(date_tuples, store.column(stock).tolist()))
         return data
 
+    def string_price_into_float(self, price_string):
+        '''
+        Converts a price such as "5,89,498" into a float, 0.0 if it is not a number.
+        :return: float price
+        '''
+        try:
+            return float(price_string.replace(',', ''))
+        except ValueError:
+            return 0.0
+
     def string_date_into_tuple(self, date_string):
         '''
         Converts a date in string format (e.g., "2024-02-02") into a tuple (year, month, day).
@@ -459,11 +1197,1574 @@ class StockDataReader():
             print(f"Error parsing date: {date_string}")
             return None
 
-def main():
-    app = QApplication(sys.argv)
+    @staticmethod
+    @functools.lru_cache(maxsize=1 << 16)
+    def string_date_into_day(date_string):
+        '''
+        Converts a date in string format (e.g., "2-2-2024" or "2/2/2024") into an integer day key (days since 1970-01-01).
+        Results are memoized because the same few thousand dates are looked up over and over.
+        :return: int day key, or None if the string is not a date
+        '''
+        day = StockDataReader.parse_date_into_day(date_string)
+        if day is None:
+            print(f"Error parsing date: {date_string}")
+        return day
+
+    @staticmethod
+    def parse_date_into_day(date_string):
+        '''
+        string_date_into_day without the memo and the error message, for strings that do not come from the data files.
+        :return: int day key, or None if the string is not a date
+        '''
+        try:
+            day, month, year = date_string.replace('/', '-').split('-')
+            return int(np.datetime64(f"{int(year):04d}-{int(month):02d}-{int(day):02d}", 'D').astype(np.int64))
+        except ValueError:
+            return None
+
+    def strings_price_into_floats(self, rows, columns):
+        '''
+        Converts a table of price strings into a float array in one vectorized pass.
+        Falls back to string_price_into_float cell by cell if the table has something that is not a number.
+        :return: float64 numpy array shaped (len(rows), columns)
+        '''
+        if len(rows) == 0 or columns == 0:
+            return np.zeros((len(rows), columns))
+        cells = np.char.replace(np.array(rows, dtype=str).reshape(len(rows), columns), ',', '')
+        try:
+            return cells.astype(np.float64)
+        except ValueError:
+            return np.array([[self.string_price_into_float(cell) for cell in row] for row in rows], dtype=np.float64).reshape(len(rows), columns)
+
+    def strings_date_into_days(self, date_strings):
+        '''
+        Converts a whole column of date strings into integer day keys in one vectorized pass.
+        Falls back to string_date_into_day row by row if the column has a malformed date.
+        :return: int64 numpy array of day keys, NAT_DAY where a date could not be parsed
+        '''
+        if len(date_strings) == 0:
+            return np.empty(0, dtype=np.int64)
+        column = np.char.replace(np.asarray(date_strings, dtype=str), '/', '-')
+        try:
+            day, _, rest = np.char.partition(column, '-').T
+            month, _, year = np.char.partition(rest, '-').T
+            years = (year.astype(np.int64) - 1970).astype('datetime64[Y]')
+            months = years.astype('datetime64[M]') + (month.astype(np.int64) - 1)
+            days = months.astype('datetime64[D]') + (day.astype(np.int64) - 1)
+            valid = (month.astype(np.int64) >= 1) & (month.astype(np.int64) <= 12) & (days.astype('datetime64[M]') == months)
+            if not valid.all():
+                raise ValueError("day or month out of range")
+            return days.astype(np.int64)
+        except ValueError:
+            days = [self.string_date_into_day(date_string) for date_string in date_strings]
+            return np.array([NAT_DAY if day is None else day for day in days], dtype=np.int64)
+
+    @staticmethod
+    def qdate_into_day(qdate):
+        '''
+        Converts a QDate into an integer day key without going through a string.
+        :return: int day key
+        '''
+        return qdate.toJulianDay() - UNIX_EPOCH_JULIAN_DAY
+
+    @staticmethod
+    def day_into_qdate(day):
+        '''
+        Converts an integer day key back into a QDate.
+        :return: QDate
+        '''
+        return QDate.fromJulianDay(int(day) + UNIX_EPOCH_JULIAN_DAY)
+
+class ColumnCache():
+    '''
+    Least recently used cache of per-stock price columns (or anything with nbytes, or bytes), bounded by a memory budget in bytes.
+    The most recent column is always kept, even if it alone is over the budget.
+    name prefixes the hit and miss counters in STATS.
+    '''
+    def __init__(self, budget_bytes, name='column_cache'):
+        self.budget_bytes = budget_bytes
+        self.name = name
+        self.columns = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        column = self.lookup(key)
+        if column is None:
+            column = loader()
+            self.put(key, column)
+        return column
+
+    def lookup(self, key):
+        '''
+        :return: the cached value, or None (counted as a miss)
+        '''
+        column = self.columns.get(key)
+        if column is None:
+            self.misses += 1
+            STATS.count(f'{self.name}_miss')
+            return None
+        self.columns.move_to_end(key)
+        self.hits += 1
+        STATS.count(f'{self.name}_hit')
+        return column
+
+    def put(self, key, column):
+        if key in self.columns:
+            self.size -= self.sizeof(self.columns.pop(key))
+        self.columns[key] = column
+        self.size += self.sizeof(column)
+        while self.size > self.budget_bytes and len(self.columns) > 1:
+            _, evicted = self.columns.popitem(last=False)
+            self.size -= self.sizeof(evicted)
+
+    @staticmethod
+    def sizeof(column):
+        return column.nbytes if hasattr(column, 'nbytes') else len(column)
+
+    def clear(self):
+        self.columns.clear()
+        self.size = 0
+
+class RangeIndex():
+    '''
+    Sparse tables over a price matrix (days x stocks) that answer the statistics of any window of rows for every stock
+    in O(1) each: high and low (range min / max), percent return (prefix sums of daily log returns) and max drawdown.
+    Level k of a table holds the answer for the 2**k rows starting at each row, so it takes O(n log n) memory per stock.
+    Days without a price (0.0) are skipped.
+    '''
+    FIELDS = ('high', 'low', 'percent_return', 'max_drawdown')
+
+    def __init__(self, prices):
+        prices = np.asarray(prices, dtype=np.float64)
+        valid = prices > 0
+        self.lows = [np.where(valid, prices, np.inf)]
+        self.highs = [np.where(valid, prices, -np.inf)]
+        self.drawdowns = [np.zeros(prices.shape)]  # Largest fall in log price, peak before trough
+
+        width = 1
+        while 2 * width <= len(prices):
+            low, high, drawdown = self.lows[-1], self.highs[-1], self.drawdowns[-1]
+            count = len(prices) - 2 * width + 1
+            # The two halves do not overlap, so the fall from the peak of the first to the trough of the second is exact
+            self.lows.append(np.minimum(low[:count], low[width:width + count]))
+            self.highs.append(np.maximum(high[:count], high[width:width + count]))
+            self.drawdowns.append(np.maximum(np.maximum(drawdown[:count], drawdown[width:width + count]),
+                                             self.fall(high[:count], low[width:width + count])))
+            width *= 2
+
+        # Prefix sums of the daily log returns telescope to the log of the price, so that is what is kept;
+        # a day without a price keeps the last one, and rows before the first price are NaN
+        carried = np.maximum.accumulate(np.where(valid, np.arange(len(prices))[:, np.newaxis], 0), axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.log_growth = np.log(np.where(np.take_along_axis(valid, carried, axis=0), np.take_along_axis(prices, carried, axis=0), np.nan))
+
+    @staticmethod
+    def fall(high, low):
+        # Log of peak over trough, 0 where either side has no price or there is no fall
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(np.fmax(high / low, 1.0))
+
+    @staticmethod
+    def table_size(rows, columns):
+        '''
+        :return: bytes a RangeIndex of this shape takes
+        '''
+        levels = max(rows, 1).bit_length()
+        entries = sum(max(rows - (1 << level) + 1, 0) for level in range(levels))
+        return (3 * entries + rows) * columns * 8
+
+    @property
+    def nbytes(self):
+        return sum(table.nbytes for table in self.lows + self.highs + self.drawdowns) + self.log_growth.nbytes
+
+    def query(self, first, last, columns=slice(None)):
+        '''
+        Statistics of the rows first..last (both inclusive, first <= last).
+        :return: dictionary of 'high', 'low', 'percent_return' and 'max_drawdown' (a positive percentage) arrays
+                 over the columns, NaN where a stock has no price in the window
+        '''
+        first, last = int(first), int(last)
+        level = (last - first + 1).bit_length() - 1
+        width = 1 << level
+        other = last - width + 1  # The two blocks overlap, which min and max do not mind
+        low = np.minimum(self.lows[level][first, columns], self.lows[level][other, columns])
+        high = np.maximum(self.highs[level][first, columns], self.highs[level][other, columns])
+        drawdown = np.maximum(self.drawdowns[level][first, columns], self.drawdowns[level][other, columns])
+        if first + width <= last:
+            # Falls from a peak in the first block to a trough after it, the rest is a window of its own
+            rest_level = (last - first - width + 1).bit_length() - 1
+            rest_low = np.minimum(self.lows[rest_level][first + width, columns], self.lows[rest_level][last - (1 << rest_level) + 1, columns])
+            drawdown = np.maximum(drawdown, self.fall(self.highs[level][first, columns], rest_low))
+
+        found = np.isfinite(high)
+        return {
+            'high': np.where(found, high, np.nan),
+            'low': np.where(found, low, np.nan),
+            'percent_return': np.where(found, np.expm1(self.log_growth[last, columns] - self.log_growth[first, columns]) * 100, np.nan),
+            'max_drawdown': np.where(found, -np.expm1(-drawdown) * 100, np.nan),
+        }
+
+def complete_lines(file, limit=None):
+    '''
+    Yields the lines of a binary file up to the last newline, or up to limit bytes;
+    a last line without its newline may still be being written.
+    '''
+    read = 0
+    for line in file:
+        if not line.endswith(b'\n') or (limit is not None and read + len(line) > limit):
+            return
+        read += len(line)
+        yield line
+
+def last_of_each_day(days):
+    '''
+    Sorts rows oldest first and keeps one row per day: the last one in file order, since a feed corrects a day by appending it again.
+    :return: row order, without the rows of days that appear again later
+    '''
+    order = np.argsort(days, kind='stable')  # Ties keep file order
+    ordered = days[order]
+    return order[np.append(ordered[1:] != ordered[:-1], True)]
+
+class PriceStore():
+    '''
+    Columnar, in-memory copy of the stock market CSV.
+
+    - prices: 2-D float array, one row per date and one column per stock
+    - days: the date axis as integer day keys (days since 1970-01-01), sorted oldest first
+    - dates: the same axis as a datetime64[D] view, ready for plotting
+    - date_index / ticker_index: map a day key / stock name to its row / column
+
+    The CSV is stored newest first; rows are sorted on load so ranges and nearest trading days are found by bisection.
+
+    Use PriceStore.shared() so the file is parsed once per process and only reloaded when it changes on disk.
+    After the first parse a binary snapshot (.npy arrays plus a JSON sidecar) is written next to the CSV,
+    later loads memory-map it instead of parsing text as long as it still matches the CSV.
+    A read-only directory moves the snapshot to the temp directory; with nowhere to write one, the CSV is parsed into memory.
+    Rows appended to the CSV later are parsed on their own (see refresh), the store remembers how many bytes it has read.
+
+    Files with more than WIDE_UNIVERSE_TICKERS stocks are streamed into a column-major snapshot instead, and prices
+    stays a memory map of it: column() copies just the stocks that are asked for into an LRU cache of
+    column_cache_bytes, so thousands of tickers never have to be resident at once.
+    Appended rows go into spare rows at the end of that snapshot (see append_to_snapshot) instead of a new stream of the CSV.
+    '''
+    _shared = {}  # path -> PriceStore, the process-wide cache
+    _shared_lock = threading.Lock()  # shared() may be called from the preload thread and the GUI at the same time
+    SNAPSHOT_VERSION = 3
+    TAIL_BYTES = 256  # Bytes before the read offset that must be unchanged for the file to count as appended to
+    WIDE_UNIVERSE_TICKERS = 1000
+    column_cache_bytes = 256 << 20
+    range_index_bytes = 256 << 20
+
+    def __init__(self, path=DATA_FILE, use_snapshot=True, lazy_columns=None):
+        self.path = path
+        self.use_snapshot = use_snapshot
+        self.snapshot_base = f"{path}.snapshot"  # See snapshot_paths, load moves it if the CSV's directory is read-only
+        self.lazy_columns = lazy_columns  # None decides from the width of the file
+        self.lazy = False
+        self.column_cache = ColumnCache(self.column_cache_bytes)
+        self.range_index = None  # RangeIndex of all stocks, see index_ranges
+        self.range_cache = ColumnCache(self.range_index_bytes, 'range_cache')  # stock -> RangeIndex when all of them would not fit
+        self.signature = None
+        self.offset = 0  # Bytes of the CSV that have been parsed
+        self.row_count = 0  # CSV rows that have been parsed
+        self.tail = b''  # The TAIL_BYTES before offset, to check that the file was only appended to
+        self.growth_buffers = None  # (days, prices) with spare rows for appends, see append_arrays
+        self.load_seconds = None  # Set when a load finishes
+        self.tickers = []
+        self.ticker_index = {}
+        self.days = np.empty(0, dtype=np.int64)
+        self.dates = self.days.view('datetime64[D]')
+        self.date_index = {}
+        self.prices = np.empty((0, 0))
+
+    @classmethod
+    def shared(cls, path=DATA_FILE):
+        '''
+        Returns the process-wide store for the file, (re)loading it only if its mtime or size has changed.
+        :return: a loaded PriceStore
+        '''
+        with cls._shared_lock:
+            store = cls._shared.get(path)
+            if store is None:
+                store = cls._shared[path] = cls(path)
+            store.refresh()
+            return store
+
+    @classmethod
+    def preload(cls, path=DATA_FILE):
+        '''
+        Starts loading the shared store on a background thread; the first shared() call waits for it.
+        :return: the started thread
+        '''
+        def load():
+            with STATS.profiled():
+                cls.shared(path)
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        return thread
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        '''
+        Brings the store up to date with the file: nothing to do if its mtime and size are unchanged,
+        only the new rows are parsed if it was appended to, and anything else is a full load.
+        :return: True if the data changed
+        '''
+        signature = self.file_signature()
+        if signature == self.signature:
+            STATS.count('store_unchanged')
+            return False
+        STATS.count('store_changed')
+        if self.offset and signature is not None and signature[1] > self.offset and self.prefix_unchanged():
+            try:
+                self.signature = signature  # Before the rows go in, a lazy store writes it to the snapshot sidecar
+                self.ingest_appended()
+                self.index_ranges()
+                return True
+            except Exception as e:
+                print(f"Error reading appended data, reloading: {e}")
+        self.load()
+        return True
+
+    @STATS.timed('data_load')
+    def load(self):
+        '''
+        Loads the price matrix from a valid snapshot, or else parses the CSV and writes a new snapshot.
+        '''
+        started = time.perf_counter()
+        self.signature = self.file_signature()
+        try:
+            # Without anywhere to write a snapshot even a wide file is parsed into memory
+            snapshots = self.use_snapshot and self.choose_snapshot_base()
+            self.lazy = snapshots and (self.lazy_columns if self.lazy_columns is not None else
+                                       len(self.read_header()) - 1 > self.WIDE_UNIVERSE_TICKERS)
+            if snapshots and self.load_snapshot():
+                STATS.count('snapshot_hit')
+                if self.offset < self.signature[1]: # The snapshot is older than rows appended since
+                    self.ingest_appended()  # A lazy store writes them into the snapshot itself
+                    if not self.lazy:
+                        self.write_snapshot()
+            elif self.lazy:
+                STATS.count('snapshot_miss')
+                self.stream_csv_into_snapshot()
+            else:
+                STATS.count('snapshot_miss' if snapshots else 'csv_parse')
+                source_hash = self.parse_csv()
+                if snapshots:
+                    self.write_snapshot(source_hash)
+            self.index_ranges()
+            print("Data loaded successfully.")
+            print(f"Stocks available: {self.tickers}")
+
+        except Exception as e:
+            print(f"Error reading data: {e}")
+        self.load_seconds = time.perf_counter() - started
+        return self
+
+    def parse_csv(self):
+        '''
+        Parses the CSV into the price matrix. Cells that are not numbers are stored as 0.0.
+        A last line without its newline yet is left for the next refresh, as in ingest_appended.
+        :return: sha256 hex digest of the parsed bytes, computed from the same read
+        '''
+        reader = StockDataReader()
+        with open(self.path, mode='rb') as file:
+            content = file.read()
+        content = content[:content.rfind(b'\n') + 1]
+        csv_reader = csv.reader(content.decode().splitlines())
+        header = next(csv_reader)
+        rows = [row for row in csv_reader if row]
+
+        tickers = header[1:]  # All columns except 'Date' are stock names
+        days = reader.strings_date_into_days([row[0] for row in rows])
+        prices = reader.strings_price_into_floats([row[1:] for row in rows], len(tickers))
+        self.set_arrays(tickers, days, prices)
+        self.set_offset(len(content), len(rows), content[-self.TAIL_BYTES:])
+        return hashlib.sha256(content).hexdigest()
+
+    def read_header(self):
+        with open(self.path, mode='r') as file:
+            return next(csv.reader([file.readline()]))
+
+    def stream_csv_into_snapshot(self, block_cells=1 << 18):
+        '''
+        Parses the CSV block by block straight into a column-major memory-mapped snapshot, then maps it.
+        Memory stays bounded by the block size instead of growing with the whole file. A block is about block_cells
+        prices, however many stocks there are, since every cell is a Python string until it is parsed.
+        '''
+        reader = StockDataReader()
+        prices_path, days_path, meta_path = self.snapshot_paths()
+        offset = row_count = 0
+        with open(self.path, mode='rb') as file:
+            for line in complete_lines(file):
+                offset += len(line)
+                row_count += bool(line.strip())
+        row_count -= 1  # The header
+
+        with open(self.path, mode='rb') as file:
+            csv_reader = csv.reader(line.decode() for line in complete_lines(file, offset))  # Not rows appended since the count
+            tickers = next(csv_reader)[1:]  # All columns except 'Date' are stock names
+            block_rows = max(1, block_cells // max(len(tickers), 1))
+            prices = np.lib.format.open_memmap(f"{prices_path}.tmp", mode='w+', dtype=np.float64,
+                                               shape=(row_count, len(tickers)), fortran_order=True)
+            days = np.empty(row_count, dtype=np.int64)
+            filled = 0
+            block = []
+            for row in itertools.chain(csv_reader, [None]):  # None flushes the last block
+                if row:
+                    block.append(row)
+                if block and (row is None or len(block) == block_rows):
+                    days[filled:filled + len(block)] = reader.strings_date_into_days([cells[0] for cells in block])
+                    prices[filled:filled + len(block)] = reader.strings_price_into_floats([cells[1:] for cells in block], len(tickers))
+                    filled += len(block)
+                    block = []
+        if filled != row_count:
+            raise ValueError("could not stream the CSV, it has rows spread over several lines")
+
+        # Sort oldest first one column at a time, the CSV is newest first. Corrected days shrink it,
+        # the rows left over past the used length become spare rows for appends
+        order = last_of_each_day(days)
+        if len(order) != row_count or not np.all(order == np.arange(row_count)):
+            for column in range(len(tickers)):
+                prices[:len(order), column] = prices[order, column]
+            days[:len(order)] = days[order]
+        prices.flush()
+        del prices
+        os.replace(f"{prices_path}.tmp", prices_path)
+        with open(f"{days_path}.tmp", mode='wb') as file:
+            np.save(file, days)
+        os.replace(f"{days_path}.tmp", days_path)
+
+        with open(self.path, mode='rb') as file:
+            file.seek(max(offset - self.TAIL_BYTES, 0))
+            tail = file.read(offset - max(offset - self.TAIL_BYTES, 0))
+        self.tickers = tickers
+        self.set_offset(offset, row_count, tail)
+        self.write_snapshot_meta(length=len(order))
+        if not self.load_snapshot():
+            raise ValueError("the snapshot that was just written does not load")
+
+    def set_offset(self, offset, row_count, tail):
+        self.offset = offset
+        self.row_count = row_count
+        self.tail = tail
+
+    def prefix_unchanged(self):
+        '''
+        :return: True if the bytes just before the read offset are still the same, i.e. the file was only appended to
+        '''
+        try:
+            with open(self.path, mode='rb') as file:
+                file.seek(self.offset - len(self.tail))
+                return file.read(len(self.tail)) == self.tail
+        except OSError:
+            return False
+
+    @STATS.timed('data_append')
+    def ingest_appended(self):
+        '''
+        Parses the complete lines after the read offset and adds them to the price arrays.
+        A last line without its newline yet is left for the next refresh, the writer may still be busy with it.
+        '''
+        reader = StockDataReader()
+        with open(self.path, mode='rb') as file:
+            file.seek(self.offset)
+            content = file.read()
+        content = content[:content.rfind(b'\n') + 1]
+        if not content:
+            return
+
+        rows = [row for row in csv.reader(content.decode().splitlines()) if row]
+        if any(len(row) != len(self.tickers) + 1 for row in rows):
+            raise ValueError("appended rows do not match the header")
+        days = reader.strings_date_into_days([row[0] for row in rows])
+        prices = reader.strings_price_into_floats([row[1:] for row in rows], len(self.tickers))
+        tail = (self.tail + content)[-self.TAIL_BYTES:]
+        offset = (self.offset + len(content), self.row_count + len(rows), tail)
+        if self.lazy:
+            self.append_to_snapshot(days, prices, offset)
+        else:
+            self.append_arrays(days, prices)
+            self.set_offset(*offset)
+        print(f"Data refreshed: {len(rows)} new rows.")
+
+    def append_arrays(self, days, prices):
+        '''
+        Adds rows in any order. Days that are already known overwrite their row, newer days go to the end,
+        into buffers that grow by doubling so a stream of small appends costs amortized O(1) per row.
+        Days older than the last known one need a re-sort, which is a full copy.
+        '''
+        order = last_of_each_day(days)  # The feed writes newest first too
+        days = days[order]
+        prices = prices[order]
+        known = np.array([day in self.date_index for day in days.tolist()], dtype=bool)
+        for day, row in zip(days[known].tolist(), prices[known]):
+            self.writable_prices()[self.date_index[day]] = row
+        self.column_cache.clear()
+        days = days[~known]
+        prices = prices[~known]
+        if len(days) == 0:
+            return
+        if len(self.days) and days[0] <= self.days[-1]:
+            self.set_arrays(self.tickers, np.concatenate((self.days, days)), np.concatenate((self.prices, prices)))
+            return
+
+        count = len(self.days)
+        needed = count + len(days)
+        if self.growth_buffers is None or len(self.growth_buffers[0]) < needed:
+            capacity = max(needed, 2 * count, 64)
+            day_buffer = np.empty(capacity, dtype=np.int64)
+            price_buffer = np.empty((capacity, len(self.tickers)), dtype=np.float64)
+            day_buffer[:count] = self.days
+            price_buffer[:count] = self.prices
+            self.growth_buffers = (day_buffer, price_buffer)
+        day_buffer, price_buffer = self.growth_buffers
+        day_buffer[count:needed] = days
+        price_buffer[count:needed] = prices
+
+        self.days = day_buffer[:needed]
+        self.dates = self.days.view('datetime64[D]')
+        self.prices = price_buffer[:needed]
+        self.date_index.update((day, count + row) for row, day in enumerate(days.tolist()))
+        self.column_cache.clear()
+
+    def append_to_snapshot(self, days, prices, offset):
+        '''
+        Adds rows to the column-major snapshot of a lazy store and maps it again.
+        The snapshot files keep spare rows after the used ones: new days are written into them and the JSON sidecar,
+        replaced last, moves the used length. When they run out both files are rewritten a column at a time with
+        a quarter more rows, so appends cost amortized O(1) disk per row without doubling a file of thousands of stocks.
+        Days that are already known or older than the last one need a new stream of the CSV.
+        :param offset: (read offset, CSV row count, tail) of the store once the rows are in
+        '''
+        order = last_of_each_day(days)  # The feed writes newest first too
+        days = days[order]
+        prices = prices[order]
+        if len(days) == 0:
+            self.set_offset(*offset)
+            return
+        if len(self.days) and days[0] <= self.days[-1]:
+            self.stream_csv_into_snapshot()
+            return
+
+        prices_path, days_path, meta_path = self.snapshot_paths()
+        count = len(self.days)
+        needed = count + len(days)
+        day_file = np.load(days_path, mmap_mode='r+')
+        price_file = np.load(prices_path, mmap_mode='r+')
+        if len(day_file) < needed:
+            capacity = max(needed, count + count // 4, 64)
+            grown_days = np.lib.format.open_memmap(f"{days_path}.tmp", mode='w+', dtype=np.int64, shape=(capacity,))
+            grown_prices = np.lib.format.open_memmap(f"{prices_path}.tmp", mode='w+', dtype=np.float64,
+                                                     shape=(capacity, len(self.tickers)), fortran_order=True)
+            grown_days[:count] = day_file[:count]
+            for column in range(len(self.tickers)):
+                grown_prices[:count, column] = price_file[:count, column]
+            del day_file, price_file
+            day_file, price_file = grown_days, grown_prices
+        day_file[count:needed] = days
+        price_file[count:needed] = prices
+        day_file.flush()
+        price_file.flush()
+        del day_file, price_file
+        for path in (days_path, prices_path):
+            if os.path.exists(f"{path}.tmp"):
+                os.replace(f"{path}.tmp", path)
+
+        self.set_offset(*offset)
+        # Written last, so it never points at rows that are not there yet. Not hashed, that would read the whole CSV
+        # on every append; a touch that keeps the size then streams the CSV again
+        self.write_snapshot_meta(length=needed, hashed=False)
+        if not self.load_snapshot():
+            raise ValueError("the snapshot that was just appended to does not load")
+
+    def writable_prices(self):
+        # A memory-mapped snapshot is read-only, copy it the first time a row is overwritten
+        if not self.prices.flags.writeable:
+            self.prices = np.array(self.prices)
+        return self.prices
+
+    def set_arrays(self, tickers, days, prices):
+        order = last_of_each_day(days)
+        if len(order) == len(days) and np.all(order == np.arange(len(days))):
+            order = slice(None)  # Already sorted, e.g. a snapshot, keep the memory map instead of copying
+        self.tickers = list(tickers)
+        self.ticker_index = {stock: column for column, stock in enumerate(self.tickers)}
+        self.days = days[order]
+        self.dates = self.days.view('datetime64[D]')
+        self.date_index = {day: row for row, day in enumerate(self.days.tolist())}
+        self.prices = prices[order]
+        self.growth_buffers = None
+        self.column_cache.clear()
+
+    def snapshot_paths(self):
+        '''
+        :return: (prices .npy, days .npy, JSON sidecar) paths of the snapshot, next to the CSV unless choose_snapshot_base moved it
+        '''
+        base = self.snapshot_base
+        return f"{base}.prices.npy", f"{base}.days.npy", f"{base}.json"
+
+    def choose_snapshot_base(self):
+        '''
+        Keeps the snapshot next to the CSV, or in the temp directory if the CSV's directory cannot be written to,
+        e.g. a read-only share. Checked by creating a file, which also catches a read-only mount.
+        :return: True if there is a writable place for the snapshot
+        '''
+        name = os.path.basename(self.path)
+        digest = hashlib.sha256(os.path.abspath(self.path).encode()).hexdigest()[:16]  # Same name, other directory
+        for base in (f"{self.path}.snapshot", os.path.join(tempfile.gettempdir(), 'stock_calculator', f"{digest}_{name}.snapshot")):
+            try:
+                directory = os.path.dirname(os.path.abspath(base))
+                os.makedirs(directory, exist_ok=True)
+                with tempfile.TemporaryFile(dir=directory):
+                    pass
+            except OSError:
+                continue
+            self.snapshot_base = base
+            return True
+        return False
+
+    def file_sha256(self):
+        digest = hashlib.sha256()
+        with open(self.path, mode='rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def load_snapshot(self):
+        '''
+        Memory-maps the snapshot if it was made from the current CSV.
+        A changed mtime with an unchanged size is settled by comparing the sha256 of the CSV.
+        :return: True if the snapshot was used
+        '''
+        prices_path, days_path, meta_path = self.snapshot_paths()
+        try:
+            with open(meta_path, mode='r') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if self.signature is None or meta.get('version') != self.SNAPSHOT_VERSION:
+            return False
+        self.set_offset(meta['size'], meta['rows'], bytes.fromhex(meta['tail']))
+        if meta['size'] < self.signature[1]:
+            if not self.prefix_unchanged(): # Not just appended to since the snapshot
+                return False
+        elif meta['size'] != self.signature[1]:
+            return False
+        elif meta.get('mtime_ns') != self.signature[0]:
+            if meta.get('sha256') is None or meta['sha256'] != self.file_sha256():
+                return False
+            meta['mtime_ns'] = self.signature[0]  # Same content, only touched: skip the hash next time
+            with contextlib.suppress(OSError): # Only saves that hash, the snapshot is still good
+                self.write_json(meta_path, meta)
+
+        try:
+            prices = np.load(prices_path, mmap_mode='r')
+            days = np.load(days_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return False
+        length = meta.get('length', -1)  # Rows in use, the rest are spare rows for appends
+        if prices.shape != (len(days), len(meta['tickers'])) or not 0 <= length <= len(days):
+            return False
+        self.set_arrays(meta['tickers'], np.asarray(days[:length]), np.asarray(prices[:length]))
+        return True
+
+    def write_snapshot(self, source_hash=None):
+        '''
+        Writes the parsed arrays next to the CSV. Files are replaced atomically, a failure only costs the next startup a parse.
+        '''
+        prices_path, days_path, meta_path = self.snapshot_paths()
+        if self.offset != self.signature[1]: # A line is still being written, the snapshot must not claim it
+            return
+        try:
+            # Column-major, so one stock is one contiguous run of the file
+            for path, array in ((prices_path, np.asfortranarray(self.prices)), (days_path, np.ascontiguousarray(self.days))):
+                with open(f"{path}.tmp", mode='wb') as file:
+                    np.save(file, array)
+                os.replace(f"{path}.tmp", path)
+            self.write_snapshot_meta(source_hash)  # Written last, so it never points at half written arrays
+        except OSError as e:
+            print(f"Error writing snapshot: {e}")
+
+    def write_snapshot_meta(self, source_hash=None, length=None, hashed=True):
+        meta = {'version': self.SNAPSHOT_VERSION, 'mtime_ns': self.signature[0], 'size': self.offset, 'rows': self.row_count,
+                'length': len(self.days) if length is None else length, 'tail': self.tail.hex(), 'sha256': source_hash or (self.file_sha256() if hashed else None), 'tickers': self.tickers}
+        self.write_json(self.snapshot_paths()[2], meta)
+
+    def write_json(self, path, content):
+        with open(f"{path}.tmp", mode='w') as file:
+            json.dump(content, file)
+        os.replace(f"{path}.tmp", path)
+
+    def row_of(self, day, snap=None):
+        '''
+        Finds the row of a day key.
+        snap=None only accepts an exact trading day, 'previous' / 'next' fall back to the closest trading day before / after it.
+        :return: row index, or None if there is no such trading day
+        '''
+        row = self.date_index.get(day)
+        if row is not None or snap is None or day == NAT_DAY:
+            return row
+        if snap == 'previous':
+            row = int(np.searchsorted(self.days, day, side='right')) - 1
+            return row if row >= 0 else None
+        if snap == 'next':
+            row = int(np.searchsorted(self.days, day, side='left'))
+            return row if row < len(self.days) else None
+        raise ValueError(f"Unknown snap mode: {snap}")
+
+    def rows_of(self, days, snap=None):
+        '''
+        Vectorized row_of for an array of day keys.
+        :return: int64 array of row indexes, -1 where there is no such trading day or the day is NAT_DAY (an unparsed date), whatever the snap mode
+        '''
+        days = np.asarray(days, dtype=np.int64)
+        count = len(self.days)
+        position = np.searchsorted(self.days, days, side='left')
+        exact = (position < count) & (self.days[np.minimum(position, count - 1)] == days) if count else np.zeros(days.shape, dtype=bool)
+        if snap is None:
+            rows = np.where(exact, position, -1)
+        elif snap == 'previous':
+            rows = np.where(exact, position, position - 1)
+        elif snap == 'next':
+            rows = np.where(position < count, position, -1)
+        else:
+            raise ValueError(f"Unknown snap mode: {snap}")
+        return np.where(days == NAT_DAY, -1, rows).astype(np.int64)
+
+    @STATS.timed('profit')
+    def batch_profit(self, buy_days, sell_days, quantity=1, snap=None):
+        '''
+        Computes the trade of every stock at once.
+        buy_days, sell_days and quantity may be scalars or arrays of the same shape (one trade scenario each).
+        :return: a dictionary of 'purchase_total', 'sell_total', 'profit' and 'percent_return' arrays,
+                 shaped like the inputs plus one last axis over tickers, NaN where a date has no data
+        '''
+        buy_rows = self.rows_of(buy_days, snap)
+        sell_rows = self.rows_of(sell_days, snap)
+        quantity = np.asarray(quantity, dtype=np.float64)[..., np.newaxis]
+        missing = ((buy_rows < 0) | (sell_rows < 0))[..., np.newaxis]
+
+        buy_prices = np.where(missing, np.nan, self.prices[buy_rows])
+        sell_prices = np.where(missing, np.nan, self.prices[sell_rows])
+        purchase_total = buy_prices * quantity
+        sell_total = sell_prices * quantity
+        profit = sell_total - purchase_total
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent_return = profit / purchase_total * 100
+
+        return {'purchase_total': purchase_total, 'sell_total': sell_total, 'profit': profit, 'percent_return': percent_return}
+
+    @STATS.timed('best_trade')
+    def best_trades(self, start_day, end_day, top_k=1, quantity=1):
+        '''
+        Finds the most profitable buy/sell pair of every stock between two day keys, both inclusive.
+        One pass keeps the running minimum (the best day to have bought) for all tickers at once, so it is O(n) per stock.
+        With top_k > 1 the k best windows that do not overlap are returned, chosen greedily: the best pair, then the best
+        pair that lies wholly before or after it, and so on. A window with no gain left is a buy and sell on the same day.
+        :return: a dictionary of 'buy_day', 'sell_day', 'buy_price', 'sell_price', 'profit' and 'percent_return' arrays
+                 shaped (top_k, number of tickers), best first; profit is NaN where a stock has no prices in the range
+        '''
+        rows = self.range_rows(start_day, end_day)
+        window = self.prices[rows]
+        window_days = self.days[rows]
+        count = window.shape[0]
+        top_k = max(1, min(top_k, count))
+        shape = (top_k, window.shape[1])
+        if count == 0:
+            return {'buy_day': np.full(shape, NAT_DAY), 'sell_day': np.full(shape, NAT_DAY), 'buy_price': np.full(shape, np.nan),
+                    'sell_price': np.full(shape, np.nan), 'profit': np.full(shape, np.nan), 'percent_return': np.full(shape, np.nan)}
+
+        # Missing prices (stored as 0.0) can be neither the buy nor the sell side
+        valid = window > 0
+        positions = np.arange(count)[:, np.newaxis]
+        taken = np.zeros(window.shape, dtype=bool)  # Rows of the windows found so far
+        segments = ranks = None
+        if top_k > 1:
+            # Sorted back to front, so of equal prices the later row ranks lower: the latest cheapest day is bought, as with prices
+            order = count - 1 - np.argsort(np.where(valid, window, np.inf)[::-1], axis=0, kind='stable')
+            ranks = np.argsort(order, axis=0)
+        picks = []
+        for _ in range(top_k):
+            picks.append(self.best_pairs(window, valid & ~taken, segments, ranks))
+            if len(picks) < top_k:
+                buy_row, sell_row, gain = picks[-1]
+                taken |= (positions >= buy_row) & (positions <= sell_row) & np.isfinite(gain)
+                segments = np.cumsum(taken, axis=0)  # A later pair may not reach across a window that was taken
+        buy_rows, sell_rows, gains = (np.stack(part) for part in zip(*picks))
+
+        found = np.isfinite(gains)
+        buy_prices = np.where(found, np.take_along_axis(window, buy_rows, axis=0), np.nan)
+        sell_prices = np.where(found, np.take_along_axis(window, sell_rows, axis=0), np.nan)
+
+        return {
+            'buy_day': np.where(found, window_days[buy_rows], NAT_DAY),
+            'sell_day': np.where(found, window_days[sell_rows], NAT_DAY),
+            'buy_price': buy_prices,
+            'sell_price': sell_prices,
+            'profit': (sell_prices - buy_prices) * quantity,
+            'percent_return': (sell_prices - buy_prices) / buy_prices * 100,
+        }
+
+    @staticmethod
+    def best_pairs(window, usable, segments=None, ranks=None):
+        '''
+        Best buy/sell pair of every column among the usable rows of a window, the buy on or before the sell.
+        With segments, an int array shaped like the window that never decreases down a column, a pair must lie
+        within one segment: later segments get lower keys, so the running minimum starts over at each of them,
+        and the ranks of the prices down each column instead of the prices keep that exact.
+        :return: (buy rows, sell rows, gains) over the columns, gain is -inf where a column has no usable row
+        '''
+        count = len(window)
+        positions = np.arange(count)[:, np.newaxis]
+        if segments is None:
+            key = np.where(usable, window, np.inf)
+        else:
+            key = np.where(usable, ranks, count) - segments * (count + 1)
+        running_min = np.minimum.accumulate(key, axis=0)
+        running_min_row = np.maximum.accumulate(np.where(key == running_min, positions, 0), axis=0)
+        bought = np.take_along_axis(usable, running_min_row, axis=0)
+        gain = np.where(usable & bought, window - np.take_along_axis(window, running_min_row, axis=0), -np.inf)
+        sell_rows = np.argmax(gain, axis=0)[np.newaxis, :]
+        buy_rows = np.take_along_axis(running_min_row, sell_rows, axis=0)
+        return buy_rows[0], sell_rows[0], np.take_along_axis(gain, sell_rows, axis=0)[0]
+
+    @STATS.timed('portfolio')
+    def simulate_portfolio(self, stocks, quantities, buy_days, sell_days, still_open=None, snap=None, block_columns=256):
+        '''
+        Simulates a book of positions day by day. A position holds quantity shares from the close of its buy day to the
+        close of its sell day, or to the last day where the still_open mask is set (its sell day is then ignored).
+        A buy or sell day of NAT_DAY (a date that did not parse) skips the position. Days without a price are marked at the last one.
+        The holdings of every day are built with bincount and cumsum per block of stocks, so there is no loop over
+        positions and memory is bounded by block_columns however wide the file is.
+        :return: a dictionary of daily arrays over the period of the book, 'dates', 'value' (market value of the open
+                 positions), 'pnl' (realized plus unrealized), 'daily_pnl', 'returns', 'cumulative_return' and 'drawdown'
+                 (below the running peak, <= 0), and of 'max_drawdown' (a positive fraction), 'positions' (simulated) and
+                 'skipped' (unknown stock or date, sold before bought, or no price on the buy or sell day)
+        '''
+        names, inverse = np.unique(np.asarray(stocks, dtype=str), return_inverse=True)
+        columns = np.array([self.ticker_index.get(name, -1) for name in names.tolist()], dtype=np.int64)[inverse.reshape(-1)]
+        quantities = np.broadcast_to(np.asarray(quantities, dtype=np.float64), columns.shape)
+        count = len(self.days)
+        buy_rows = self.rows_of(buy_days, snap)
+        still_open = np.zeros(columns.shape, dtype=bool) if still_open is None else np.asarray(still_open, dtype=bool)
+        sell_rows = np.where(still_open, count, self.rows_of(sell_days, snap))
+
+        known = (columns >= 0) & (buy_rows >= 0) & (sell_rows >= buy_rows)
+        buy_prices = np.where(known, self.prices[np.where(known, buy_rows, 0), np.maximum(columns, 0)], np.nan)
+        sell_prices = np.where(known & ~still_open, self.prices[np.where(known & ~still_open, sell_rows, 0), np.maximum(columns, 0)], np.nan)
+        valid = known & (buy_prices > 0) & (still_open | (sell_prices > 0))
+
+        result = {'positions': int(valid.sum()), 'skipped': int(len(columns) - valid.sum())}
+        if not valid.any():
+            empty = np.empty(0)
+            return dict(result, dates=self.dates[:0], value=empty, pnl=empty, daily_pnl=empty, returns=empty,
+                        cumulative_return=empty, drawdown=empty, max_drawdown=0.0)
+
+        order = np.argsort(columns[valid], kind='stable')  # Grouped by stock for the blocks
+        columns, quantities = columns[valid][order], quantities[valid][order]
+        buy_rows, sell_rows, still_open = buy_rows[valid][order], sell_rows[valid][order], still_open[valid][order]
+        buy_prices, sell_prices = buy_prices[valid][order], sell_prices[valid][order]
+        first = int(buy_rows.min())
+        last = count - 1 if still_open.any() else int(sell_rows.max())
+        period = last - first + 1
+
+        # Cash side: what was paid for the positions bought and received for the ones sold, up to every day
+        cost = np.cumsum(np.bincount(buy_rows - first, weights=quantities * buy_prices, minlength=period))
+        closed = ~still_open
+        proceeds = np.cumsum(np.bincount(sell_rows[closed] - first, weights=quantities[closed] * sell_prices[closed], minlength=period))
+
+        # Market side: holdings (days x stocks of the block) start at the buy row and stop at the sell row
+        value = np.zeros(period)
+        used, starts = np.unique(columns, return_index=True)
+        starts = np.append(starts, len(columns))
+        for block in range(0, len(used), block_columns):
+            block_used = used[block:block + block_columns]
+            positions = slice(starts[block], starts[min(block + block_columns, len(used))])
+            width = len(block_used)
+            local = np.searchsorted(block_used, columns[positions])
+            size = (period + 1) * width  # One spare row for the positions that are still open
+            delta = np.bincount((buy_rows[positions] - first) * width + local, weights=quantities[positions], minlength=size)
+            delta -= np.bincount((np.minimum(sell_rows[positions], last + 1) - first) * width + local, weights=quantities[positions], minlength=size)
+            holdings = np.cumsum(delta.reshape(period + 1, width)[:period], axis=0)
+            value += np.einsum('ij,ij->i', holdings, self.marked_prices(first, last, block_used))
+
+        pnl = value + proceeds - cost
+        daily_pnl = np.diff(pnl, prepend=0.0)
+        previous_value = np.concatenate(([0.0], value[:-1]))
+        returns = np.divide(daily_pnl, previous_value, out=np.zeros(period), where=previous_value > 0)
+        wealth = np.cumprod(1 + returns)
+        drawdown = wealth / np.maximum.accumulate(wealth) - 1
+
+        return dict(result, dates=self.dates[first:last + 1], value=value, pnl=pnl, daily_pnl=daily_pnl, returns=returns,
+                    cumulative_return=wealth - 1, drawdown=drawdown, max_drawdown=float(-drawdown.min()))
+
+    def marked_prices(self, first, last, columns):
+        '''
+        :return: prices of the rows first..last (inclusive) and the given columns, a day without a price takes the last one before it
+        '''
+        block = np.asarray(self.prices[first:last + 1][:, columns])
+        valid = block > 0
+        carried = np.maximum.accumulate(np.where(valid, np.arange(len(block))[:, np.newaxis], 0), axis=0)
+        marks = np.take_along_axis(block, carried, axis=0)
+        marks[~np.take_along_axis(valid, carried, axis=0)] = 0.0  # No price yet, nothing can be held there either
+        return marks
+
+    def index_ranges(self):
+        '''
+        Builds the RangeIndex of all stocks if it fits in range_index_bytes; otherwise range_stats builds
+        the index of each stock it is asked about and keeps it in an LRU cache of the same budget.
+        '''
+        self.range_cache.clear()
+        self.range_index = None
+        if not self.lazy and RangeIndex.table_size(len(self.days), len(self.tickers)) <= self.range_index_bytes:
+            with STATS.timer('range_index_build'):
+                self.range_index = RangeIndex(self.prices)
+
+    def range_stats(self, start_day, end_day, stocks=None):
+        '''
+        High, low, percent return and max drawdown between two day keys, both inclusive, in O(1) per stock.
+        :return: dictionary of 'high', 'low', 'percent_return' and 'max_drawdown' arrays over stocks (all tickers if None),
+                 NaN where a stock has no price in the range
+        '''
+        rows = self.range_rows(start_day, end_day)
+        names = self.tickers if stocks is None else list(stocks)
+        if rows.stop <= rows.start:
+            return {field: np.full(len(names), np.nan) for field in RangeIndex.FIELDS}
+        if self.range_index is not None:
+            columns = slice(None) if stocks is None else [self.ticker_index[stock] for stock in names]
+            return self.range_index.query(rows.start, rows.stop - 1, columns)
+        if RangeIndex.table_size(len(self.days), len(names)) > self.range_index_bytes:
+            # More stocks than the cache can keep indexes for, one pass over the window is cheaper than building them
+            return self.scan_range_stats(rows.start, rows.stop - 1, [self.ticker_index[stock] for stock in names])
+
+        stats = [self.range_cache.get(stock, lambda: RangeIndex(self.column(stock)[:, np.newaxis])).query(rows.start, rows.stop - 1)
+                 for stock in names]
+        return {field: np.concatenate([stat[field] for stat in stats]) if stats else np.empty(0) for field in RangeIndex.FIELDS}
+
+    def scan_range_stats(self, first, last, columns, block_columns=256):
+        '''
+        range_stats without an index, one pass over the window a block of stocks at a time: O(n) per stock.
+        '''
+        stats = {field: [] for field in RangeIndex.FIELDS}
+        for block in range(0, len(columns), block_columns):
+            chosen = columns[block:block + block_columns]
+            window = np.asarray(self.prices[first:last + 1][:, chosen])
+            valid = window > 0
+            high = np.where(valid, window, -np.inf).max(axis=0)
+            peaks = np.maximum.accumulate(np.where(valid, window, -np.inf), axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                falls = np.where(valid & (peaks > 0), 1 - window / peaks, 0.0).max(axis=0)
+            found = np.isfinite(high)
+            stats['high'].append(np.where(found, high, np.nan))
+            stats['low'].append(np.where(found, np.where(valid, window, np.inf).min(axis=0), np.nan))
+            stats['percent_return'].append(np.where(found, (self.last_prices(last, chosen) / self.last_prices(first, chosen) - 1) * 100, np.nan))
+            stats['max_drawdown'].append(np.where(found, falls * 100, np.nan))
+        return {field: np.concatenate(values) if values else np.empty(0) for field, values in stats.items()}
+
+    def last_prices(self, row, columns):
+        '''
+        :return: the price of each column on the row, or the last one before it if the row has none; NaN if there is none at all
+        '''
+        before = np.asarray(self.prices[:row + 1][:, columns])
+        valid = before > 0
+        rows = row - np.argmax(valid[::-1], axis=0)
+        return np.where(valid.any(axis=0), before[rows, np.arange(before.shape[1])], np.nan)
+
+    def trading_day(self, day, snap=None):
+        '''
+        :return: the day key that a lookup of day with this snap mode resolves to, or None
+        '''
+        row = self.row_of(day, snap)
+        return None if row is None else int(self.days[row])
+
+    def has_price(self, stock, day, snap=None):
+        return stock in self.ticker_index and self.row_of(day, snap) is not None
+
+    def price(self, stock, day, snap=None):
+        '''
+        Looks up the price of one stock on one day key.
+        :return: the price as a float, or None if the stock or day is not in the data
+        '''
+        row = self.row_of(day, snap)
+        if stock not in self.ticker_index or row is None:
+            return None
+        return float(self.prices[row, self.ticker_index[stock]])
+
+    def range_rows(self, start_day, end_day):
+        '''
+        :return: the slice of rows whose day keys are between start_day and end_day, both inclusive
+        '''
+        first = int(np.searchsorted(self.days, start_day, side='left'))
+        last = int(np.searchsorted(self.days, end_day, side='right'))
+        return slice(first, max(first, last))
+
+    def range_series(self, stock, start_day, end_day):
+        '''
+        Slices one stock between two day keys, both inclusive. The arrays are views, nothing is copied.
+        :return: (datetime64[D] dates, prices)
+        '''
+        rows = self.range_rows(start_day, end_day)
+        return self.dates[rows], self.column(stock)[rows]
+
+    def column(self, stock):
+        '''
+        :return: the whole price column of a stock, in the same order as days; read through the column cache for wide files
+        '''
+        column = self.ticker_index[stock]
+        if not self.lazy:
+            return self.prices[:, column]
+        return self.column_cache.get(stock, lambda: np.array(self.prices[:, column]))
+
+SCENARIO_FIELDS = ['stock', 'buy_date', 'sell_date', 'quantity']
+RESULT_FIELDS = SCENARIO_FIELDS + ['purchase_total', 'sell_total', 'profit', 'percent_return']
+
+def read_scenario_chunks(file, chunk_size):
+    '''
+    Streams raw lines of a scenario file in chunks, so memory stays bounded by the chunk size.
+    Each chunk is joined into one string, which is much cheaper to send to a worker process than a list.
+    :return: generator of strings
+    '''
+    chunk = []
+    for line in file:
+        if line.strip():
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+def json_floats(values):
+    # NaN and infinity are not JSON, missing prices and returns on a zero price come out as null
+    return [value if np.isfinite(value) else None for value in np.asarray(values, dtype=np.float64).tolist()]
+
+def evaluate_scenarios(text, header, data_path=DATA_FILE, snap=None, output_format='csv'):
+    '''
+    Evaluates one chunk of scenario lines (stock, buy date, sell date, quantity) against the shared PriceStore.
+    header is the list of CSV column names, or None if the lines are JSON objects.
+    :return: (number of scenarios, the result lines as one string)
+    '''
+    store = PriceStore.shared(data_path)
+    reader = StockDataReader()
+    lines = text.splitlines()
+
+    if header is None:
+        records = [json.loads(line) for line in lines]
+        scenarios = [[str(record.get(field, '')) for field in SCENARIO_FIELDS] for record in records]
+    else:
+        positions = [header.index(field) for field in SCENARIO_FIELDS]
+        scenarios = [[row[position] for position in positions] for row in csv.reader(lines)]
+    stocks, buy_dates, sell_dates, quantities = zip(*scenarios)
+    echoed_quantities = quantities if header is not None else [record.get('quantity') for record in records]  # As given
+
+    # Vectorized lookup of the whole chunk, unknown stocks and dates come out as NaN
+    # Scenario files repeat the same dates a lot, so the memoized parser beats the vectorized one here
+    columns = np.array([store.ticker_index.get(stock, -1) for stock in stocks], dtype=np.int64)
+    buy_days = [reader.string_date_into_day(date_string) for date_string in buy_dates]
+    sell_days = [reader.string_date_into_day(date_string) for date_string in sell_dates]
+    buy_rows = store.rows_of([NAT_DAY if day is None else day for day in buy_days], snap)
+    sell_rows = store.rows_of([NAT_DAY if day is None else day for day in sell_days], snap)
+    quantity = np.array([reader.string_price_into_float(value) for value in quantities])
+    missing = (columns < 0) | (buy_rows < 0) | (sell_rows < 0)
+
+    purchase_total = np.where(missing, np.nan, store.prices[buy_rows, columns] * quantity)
+    sell_total = np.where(missing, np.nan, store.prices[sell_rows, columns] * quantity)
+    profit = sell_total - purchase_total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_return = profit / purchase_total * 100
+
+    if output_format == 'jsonl':
+        totals = (json_floats(purchase_total), json_floats(sell_total), json_floats(profit), json_floats(percent_return))
+        results = zip(stocks, buy_dates, sell_dates, echoed_quantities, *totals)
+        return len(scenarios), ''.join(json.dumps(dict(zip(RESULT_FIELDS, result))) + '\n' for result in results)
+
+    totals = zip(purchase_total.tolist(), sell_total.tolist(), profit.tolist(), percent_return.tolist())
+    if header == SCENARIO_FIELDS:
+        # The input line already is the first four columns of the result
+        text = ''.join('%s,%.6f,%.6f,%.6f,%.6f\n' % (line, *total) for line, total in zip(lines, totals))
+    else:
+        inputs = [','.join(csv_quote(value) for value in scenario) for scenario in scenarios]
+        text = ''.join('%s,%.6f,%.6f,%.6f,%.6f\n' % (line, *total) for line, total in zip(inputs, totals))
+    return len(scenarios), text
+
+def csv_quote(value):
+    if ',' in value or '"' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+def run_batch(input_path, output_file, data_path=DATA_FILE, chunk_size=100000, workers=None, snap=None, output_format=None):
+    '''
+    Streams scenarios from a CSV or JSONL file through a process pool and writes the results in input order.
+    At most two chunks per worker are in flight, so memory is bounded whatever the size of the input.
+    :return: (number of scenarios, seconds taken)
+    '''
+    workers = workers or os.cpu_count() or 1
+    is_jsonl = input_path.endswith('.jsonl')
+    output_format = output_format or ('jsonl' if is_jsonl else 'csv')
+    started = time.perf_counter()
+    total = 0
+    PriceStore.shared(data_path) # Parse once, before forking, so the workers inherit it
+
+    with open(input_path, mode='r') as file:
+        header = None if is_jsonl else next(csv.reader([file.readline()]))
+        if output_format == 'csv':
+            output_file.write(','.join(RESULT_FIELDS) + '\n')
+        chunks = read_scenario_chunks(file, chunk_size)
+
+        if workers == 1:
+            for chunk in chunks:
+                count, text = evaluate_scenarios(chunk, header, data_path, snap, output_format)
+                output_file.write(text)
+                total += count
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = []
+                for chunk in chunks:
+                    pending.append(pool.submit(evaluate_scenarios, chunk, header, data_path, snap, output_format))
+                    if len(pending) >= 2 * workers:
+                        count, text = pending.pop(0).result()
+                        output_file.write(text)
+                        total += count
+                for future in pending:
+                    count, text = future.result()
+                    output_file.write(text)
+                    total += count
+
+    return total, time.perf_counter() - started
+
+def batch_main(argv=None):
+    '''
+    Headless entry point: python StockTradeCalculator.py batch scenarios.csv -o results.csv
+    '''
+    parser = argparse.ArgumentParser(prog='StockTradeCalculator.py batch', description='Evaluate trade scenarios without the GUI.')
+    parser.add_argument('input', help='CSV with a stock,buy_date,sell_date,quantity header, or JSONL with the same keys')
+    parser.add_argument('-o', '--output', help='result file, standard output if omitted')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help='result format, defaults to the input format')
+    parser.add_argument('--data', default=DATA_FILE, help='stock market CSV')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='scenarios per task')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, all cores by default')
+    parser.add_argument('--snap', choices=['previous', 'next'], help='use the nearest trading day for closed dates')
+    args = parser.parse_args(argv)
+
+    output_file = open(args.output, mode='w') if args.output else sys.stdout
+    try:
+        with contextlib.redirect_stdout(sys.stderr): # Keep the loader messages out of the results
+            total, seconds = run_batch(args.input, output_file, args.data, args.chunk_size, args.workers, args.snap, args.format)
+    finally:
+        if args.output:
+            output_file.close()
+    print(f"Evaluated {total} scenarios in {seconds:.2f}s ({total / max(seconds, 1e-9):,.0f} scenarios/s)", file=sys.stderr)
+    return 0
+
+PORTFOLIO_FIELDS = ['date', 'value', 'pnl', 'daily_pnl', 'return', 'cumulative_return', 'drawdown']
+
+def read_positions(path):
+    '''
+    Reads a book of positions: a CSV with a stock,buy_date,sell_date,quantity header (the batch scenario format)
+    or JSONL with the same keys. An empty sell_date keeps the position open; dates that do not parse are NAT_DAY.
+    :return: (stocks, quantities, buy_days, sell_days, still_open) arrays
+    '''
+    reader = StockDataReader()
+    with open(path, mode='r') as file:
+        if path.endswith('.jsonl'):
+            records = [json.loads(line) for line in file if line.strip()]
+            rows = [[str(record.get(field, '') or '') for field in SCENARIO_FIELDS] for record in records]
+        else:
+            csv_reader = csv.reader(file)
+            header = next(csv_reader)
+            positions = [header.index(field) for field in SCENARIO_FIELDS]
+            rows = [[row[position] for position in positions] for row in csv_reader if row]
+    if not rows:
+        return np.empty(0, dtype=str), np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+
+    stocks, buy_dates, sell_dates, quantities = (np.array(values) for values in zip(*rows))
+    sell_days = np.full(len(rows), NAT_DAY)
+    still_open = np.char.strip(sell_dates) == ''
+    sell_days[~still_open] = reader.strings_date_into_days(sell_dates[~still_open])
+    quantities = np.array([reader.string_price_into_float(value) for value in quantities.tolist()])
+    return stocks, quantities, reader.strings_date_into_days(buy_dates), sell_days, still_open
+
+def simulate_portfolio_file(store, path, snap=None):
+    '''
+    :return: the PriceStore.simulate_portfolio result of the positions in a file
+    '''
+    return store.simulate_portfolio(*read_positions(path), snap=snap)
+
+def portfolio_main(argv=None):
+    '''
+    Headless entry point: python StockTradeCalculator.py portfolio positions.csv -o daily.csv --plot portfolio.png
+    '''
+    parser = argparse.ArgumentParser(prog='StockTradeCalculator.py portfolio', description='Simulate a book of positions day by day.')
+    parser.add_argument('input', help='CSV with a stock,buy_date,sell_date,quantity header, or JSONL with the same keys; an empty sell_date stays open')
+    parser.add_argument('-o', '--output', help='daily CSV (date, value, P&L, return, drawdown), standard output if omitted')
+    parser.add_argument('--plot', metavar='PNG', help='also render the value and P&L chart to an image')
+    parser.add_argument('--data', default=DATA_FILE, help='stock market CSV')
+    parser.add_argument('--snap', choices=['previous', 'next'], help='use the nearest trading day for closed dates')
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr): # Keep the loader messages out of the results
+        result = simulate_portfolio_file(PriceStore.shared(args.data), args.input, args.snap)
+    seconds = time.perf_counter() - started
+
+    output_file = open(args.output, mode='w') if args.output else sys.stdout
+    try:
+        output_file.write(','.join(PORTFOLIO_FIELDS) + '\n')
+        columns = [result['dates'].astype(str).tolist()] + [result[field].tolist() for field in ('value', 'pnl', 'daily_pnl', 'returns', 'cumulative_return', 'drawdown')]
+        output_file.write(''.join('%s,%.6f,%.6f,%.6f,%.8f,%.8f,%.8f\n' % row for row in zip(*columns)))
+    finally:
+        if args.output:
+            output_file.close()
+
+    if args.plot:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')  # No window is shown
+        app = QApplication.instance() or QApplication(sys.argv[:1])
+        canvas = load_matplotlib_canvas()()
+        canvas.plot_portfolio(result['dates'], result['value'], result['pnl'], result['max_drawdown'])
+        canvas.figure.savefig(args.plot)
+
+    final_pnl = result['pnl'][-1] if len(result['pnl']) else 0.0
+    print(f"Simulated {result['positions']} positions ({result['skipped']} skipped) over {len(result['dates'])} days in {seconds:.2f}s: "
+          f"P&L ${final_pnl:,.2f}, max drawdown {result['max_drawdown']:.2%}", file=sys.stderr)
+    return 0
+
+class ReadWriteLock():
+    '''
+    Any number of readers or one writer; a waiting writer holds back new readers so it is not starved.
+    '''
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self.condition:
+            while self.writer or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+class QueryServer():
+    '''
+    Answers price, range series and profit queries over HTTP/JSON from the shared PriceStore, for tools that want the
+    numbers of the dialog without the GUI. Only GET, with the parameters in the query string:
+
+    - /stocks: the stock names and the first and last date
+    - /price?stock=Apple&date=03-01-2023[&snap=previous]
+    - /series?stock=Apple&start=03-01-2023&end=02-01-2024[&points=600]: points decimates with min_max_decimate
+    - /profit?buy=03-01-2023&sell=02-01-2024[&quantity=10][&stocks=Apple,Gold][&snap=previous]: every stock if stocks is omitted
+    - /stats: the STATS timers and counters
+
+    Dates are dd-mm-yyyy, d/m/yyyy like the CSV, or yyyy-mm-dd. Connections are served by asyncio and the lookups run on a
+    thread pool, so a long series does not hold up the other clients. The lookups share a ReadWriteLock with the refresh
+    of the store, which changes its arrays one after the other. Successful responses are kept in an LRU cache of
+    cache_bytes, which is emptied when the CSV changes (it is checked every refresh_seconds); a response computed
+    before a change is not cached, every entry belongs to the current data generation.
+    The server modules (asyncio alone is tens of milliseconds) are imported in its methods, not on the GUI's cold start.
+    '''
+    ENDPOINTS = ('/stocks', '/price', '/series', '/profit', '/stats')
+    REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+    def __init__(self, data_path=DATA_FILE, cache_bytes=64 << 20, workers=4, refresh_seconds=1.0):
+        self.data_path = data_path
+        self.cache = ColumnCache(cache_bytes, 'response_cache')
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.refresh_seconds = refresh_seconds
+        self.reader = StockDataReader()
+        self.store = None
+        self.store_lock = ReadWriteLock()
+        self.generation = 0  # Bumped when the data changes
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.store = await loop.run_in_executor(self.executor, PriceStore.shared, self.data_path)
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving {self.data_path} on http://{host}:{server.sockets[0].getsockname()[1]}", file=sys.stderr)
+        async with server:
+            refresher = asyncio.create_task(self.watch_data())
+            try:
+                await server.serve_forever()
+            finally:
+                refresher.cancel()
+
+    async def watch_data(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            if await loop.run_in_executor(self.executor, self.refresh):
+                self.cache.clear()
+
+    def refresh(self):
+        '''
+        Runs on the thread pool.
+        :return: True if the data changed
+        '''
+        if self.store.file_signature() == self.store.signature: # Nothing to do, keep the readers going
+            return False
+        with self.store_lock.writing():
+            changed = refresh_store(self.data_path)
+            if changed:
+                self.generation += 1
+        return changed
+
+    async def handle_connection(self, reader, writer):
+        '''
+        HTTP/1.1 with keep-alive, one request at a time per connection.
+        '''
+        import asyncio
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get('content-length', 0)): # No endpoint takes a body, skip it
+                    await reader.readexactly(int(headers['content-length']))
+
+                status, body = await self.respond(method, target)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                head = (f"{version} {status} {self.REASONS[status]}\r\nContent-Type: application/json\r\n"
+                        f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+                writer.write(head.encode('latin-1') + (body if method != 'HEAD' else b''))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass # The client went away or sent something that is not HTTP
+        finally:
+            writer.close()
+
+    async def respond(self, method, target):
+        '''
+        :return: (HTTP status, JSON body bytes)
+        '''
+        import asyncio
+        import urllib.parse
+        if method not in ('GET', 'HEAD'):
+            return 405, b'{"error": "only GET is supported"}'
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path not in self.ENDPOINTS:
+            return 404, json.dumps({'error': f"unknown endpoint {url.path}, try one of {', '.join(self.ENDPOINTS)}"}).encode()
+        if url.path == '/stats':
+            return 200, json.dumps(STATS.snapshot()).encode()
+
+        key = url.path + '?' + urllib.parse.urlencode(sorted(params.items()))
+        body = self.cache.lookup(key)
+        if body is not None:
+            return 200, body
+        generation = self.generation
+        with STATS.timer(f'server{url.path.replace("/", "_")}'):
+            status, body = await asyncio.get_running_loop().run_in_executor(self.executor, self.answer, url.path, params)
+        if status == 200 and generation == self.generation: # The data may have changed while it was computed
+            self.cache.put(key, body)
+        return status, body
+
+    def answer(self, path, params):
+        '''
+        Runs on the thread pool.
+        :return: (HTTP status, JSON body bytes)
+        '''
+        try:
+            with self.store_lock.reading():
+                status, content = getattr(self, 'answer_' + path[1:])(params)
+        except (KeyError, ValueError) as e:
+            status, content = 400, {'error': f"bad parameters: {e.args[0] if e.args else e}"}
+        except Exception as e:
+            STATS.count('errors')
+            traceback.print_exc()
+            status, content = 500, {'error': str(e)}
+        return status, json.dumps(content).encode()
+
+    def answer_stocks(self, params):
+        store = self.store
+        first, last = (store.dates[[0, -1]].astype(str).tolist() if len(store.dates) else (None, None))
+        return 200, {'stocks': store.tickers, 'first_date': first, 'last_date': last}
+
+    def answer_price(self, params):
+        store = self.store
+        stock = self.parse_stock(params['stock'])
+        day = self.parse_day(params['date'])
+        snap = self.parse_snap(params)
+        price = store.price(stock, day, snap)
+        if price is None:
+            return 404, {'error': f"no price of {stock} on {params['date']}"}
+        return 200, {'stock': stock, 'date': self.iso_date(day), 'trading_date': self.iso_date(store.trading_day(day, snap)), 'price': price}
+
+    def answer_series(self, params):
+        stock = self.parse_stock(params['stock'])
+        dates, prices = self.store.range_series(stock, self.parse_day(params['start']), self.parse_day(params['end']))
+        if 'points' in params:
+            dates, prices = min_max_decimate(dates, prices, max(int(params['points']) // 2, 1))
+        return 200, {'stock': stock, 'dates': dates.astype(str).tolist(), 'prices': prices.tolist()}
+
+    def answer_profit(self, params):
+        store = self.store
+        buy_day = self.parse_day(params['buy'])
+        sell_day = self.parse_day(params['sell'])
+        quantity = float(params.get('quantity', 1))
+        stocks = [self.parse_stock(stock) for stock in params['stocks'].split(',')] if params.get('stocks') else store.tickers
+        totals = store.batch_profit(buy_day, sell_day, quantity, self.parse_snap(params))
+        columns = [store.ticker_index[stock] for stock in stocks]
+        fields = {field: json_floats(values[columns]) for field, values in totals.items()}
+        results = {stock: {field: values[position] for field, values in fields.items()} for position, stock in enumerate(stocks)}
+        return 200, {'buy_date': self.iso_date(buy_day), 'sell_date': self.iso_date(sell_day), 'quantity': quantity, 'results': results}
+
+    def parse_stock(self, stock):
+        if stock not in self.store.ticker_index:
+            raise KeyError(f"unknown stock {stock}")
+        return stock
+
+    def parse_snap(self, params):
+        # Checked up front, the store only looks at snap when a date is not a trading day
+        snap = params.get('snap')
+        if snap not in (None, 'previous', 'next'):
+            raise ValueError(f"snap must be previous or next, not {snap}")
+        return snap
+
+    def parse_day(self, date_string):
+        # Client input, so it is not memoized: every distinct string would stay in the cache
+        if len(date_string) == 10 and date_string[4] == '-' and date_string[7] == '-': # yyyy-mm-dd
+            return int(np.datetime64(date_string, 'D').astype(np.int64))
+        day = self.reader.parse_date_into_day(date_string)
+        if day is None:
+            raise ValueError(f"not a date: {date_string}")
+        return day
+
+    @staticmethod
+    def iso_date(day):
+        return None if day is None else str(np.datetime64(day, 'D'))
+
+def serve_main(argv=None):
+    '''
+    Server entry point: python StockTradeCalculator.py serve --port 8765
+    '''
+    parser = argparse.ArgumentParser(prog='StockTradeCalculator.py serve', description='Answer price and profit queries over HTTP/JSON.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on, only this machine by default')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--data', default=DATA_FILE, help='stock market CSV')
+    parser.add_argument('--cache-mb', type=int, default=64, help='memory for cached responses')
+    parser.add_argument('--workers', type=int, default=4, help='threads for the lookups')
+    args = parser.parse_args(argv)
+
+    import asyncio
+    server = QueryServer(args.data, args.cache_mb << 20, args.workers)
+    try:
+        with contextlib.redirect_stdout(sys.stderr): # Loader messages
+            asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def report_startup_timing(destination, main_started, path=DATA_FILE):
+    '''
+    Prints (destination '-') or appends to a file one JSON line with the cold-start phases, in seconds.
+    Called from the event loop right after the dialog was first painted.
+    The store is looked up without PriceStore.shared(), which would wait for the preload thread on the GUI thread
+    and count that wait as paint time; data_load is null if the preload has not finished yet.
+    '''
+    painted = time.perf_counter()
+    store = PriceStore._shared.get(path)
+    timing = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'import': IMPORT_FINISHED - IMPORT_STARTED,
+        'data_load': None if store is None else store.load_seconds,
+        'first_paint': painted - main_started,
+        'total': painted - IMPORT_STARTED,
+    }
+    line = json.dumps(timing)
+    if destination == '-':
+        print(line, file=sys.stderr)
+    else:
+        with open(destination, mode='a') as file:
+            file.write(line + '\n')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='StockTradeCalculator.py', description='Stock trade profit calculator.')
+    parser.add_argument('--startup-timing', nargs='?', const='-', metavar='FILE',
+                        help='report import, data load and first paint times as JSON, to stderr or appended to FILE')
+    parser.add_argument('--watch', action='store_true', help='refresh the calculator and charts when rows are added to the CSV')
+    parser.add_argument('--stats', metavar='FILE', default=os.environ.get('STOCK_CALC_STATS'),
+                        help='write the timers and counters as JSON to FILE on exit (or set STOCK_CALC_STATS)')
+    parser.add_argument('--profile', metavar='FILE', default=os.environ.get('STOCK_CALC_PROFILE'),
+                        help='run under cProfile, including the data load and worker threads, and write the stats to FILE on exit (or set STOCK_CALC_PROFILE)')
+    args, qt_args = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    main_started = time.perf_counter()
+    profiler = None
+    if args.profile:
+        import cProfile
+        STATS.profilers = []  # The preload and worker threads profile themselves
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    PriceStore.preload() # Parse or map the data while Qt starts up
+    app = QApplication(sys.argv[:1] + qt_args)
     stock_calculator = StockTradeProfitCalculator()
     stock_calculator.show()
-    sys.exit(app.exec())
+    if args.watch:
+        stock_calculator.watch_data_file()
+    if args.startup_timing:
+        QTimer.singleShot(0, lambda: report_startup_timing(args.startup_timing, main_started, stock_calculator.data_path))
+    exit_code = app.exec()
+
+    if profiler is not None:
+        profiler.disable()
+        stats = STATS.profile_stats(profiler)
+        stats.dump_stats(args.profile)
+        stats.sort_stats('cumulative').print_stats(20)
+    if args.stats:
+        STATS.dump(args.stats)
+    sys.exit(exit_code)
 # This is complete
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(batch_main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'portfolio':
+        sys.exit(portfolio_main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        sys.exit(serve_main(sys.argv[2:]))
+    else:
         main()
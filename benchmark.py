@@ -0,0 +1,388 @@
+'''
+Benchmark suite for StockTradeCalculator.
+
+Generates synthetic datasets in the same format as Transformed_Stock_Market_Dataset.csv (newest first,
+both date styles, quoted prices with thousands separators) and times the hot paths of the calculator.
+Results are written as JSON so runs on different commits can be compared:
+
+    python benchmark.py --years 5 --tickers 100 -o before.json
+    python benchmark.py --years 5 --tickers 100 -o after.json --compare before.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import contextlib
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')  # Charts are rendered without a display
+
+import numpy as np
+
+import StockTradeCalculator as calculator
+
+PRESETS = {
+    'small': (4, 19),  # About the size of the bundled CSV
+    'medium': (10, 500),
+    'production': (20, 10000),
+}
+TRADING_DAYS_PER_YEAR = 261
+# Whole-file, in-memory paths that a wide dataset (more than PriceStore.WIDE_UNIVERSE_TICKERS stocks) is never loaded
+# through; at 20 years x 10k tickers they would need about 10 GB. snapshot_build times the streaming parse instead
+IN_MEMORY_BENCHMARKS = ('csv_parse', 'make_data')
+
+def generate_dataset(path, years, tickers, seed=0, block_rows=256):
+    '''
+    Writes a synthetic stock market CSV: one row per weekday, newest first, a random walk per ticker.
+    Dates alternate between the "31-01-2024" and "2/2/2024" styles, prices of 1000 and more are quoted
+    with thousands separators and every fifth ticker uses the Indian grouping of the bundled Berkshire column.
+    The walk is drawn block_rows rows at a time, so memory does not grow with the size of the dataset.
+    '''
+    rng = np.random.default_rng(seed)
+    rows = years * TRADING_DAYS_PER_YEAR
+    last_day = np.datetime64('2024-02-02')
+    days = np.busday_offset(last_day, -np.arange(rows), roll='backward')  # Newest first
+
+    start = rng.uniform(1, 50000, tickers)
+    indian = (np.arange(tickers) % 5 == 4).tolist()
+    walk = np.zeros(tickers)  # Sum of the steps so far
+
+    with open(path, mode='w') as file:
+        file.write('Date,' + ','.join(f'Stock_{i}' for i in range(tickers)) + '\n')
+        for first in range(0, rows, block_rows):
+            steps = rng.normal(0, 0.02, (min(block_rows, rows - first), tickers))
+            steps[0] += walk  # Carried into the sum in the same order as one cumsum over all rows
+            sums = np.cumsum(steps, axis=0)
+            walk = sums[-1]
+            prices = np.round(start * np.exp(sums), 2)
+            for row, day in enumerate(days[first:first + len(prices)].tolist(), first):
+                date = f'{day.day}/{day.month}/{day.year}' if row % 2 else f'{day.day:02d}-{day.month:02d}-{day.year}'
+                cells = [format_price(price, indian_grouping) for price, indian_grouping in zip(prices[row - first].tolist(), indian)]
+                file.write(date + ',' + ','.join(cells) + '\n')
+
+def format_price(price, indian_grouping=False):
+    if price < 1000:
+        return repr(price)
+    if not indian_grouping:
+        return f'"{price:,.2f}"'
+    whole, fraction = f'{price:.2f}'.split('.')
+    head, tail = whole[:-3], whole[-3:]
+    groups = []
+    while len(head) > 2:
+        groups.insert(0, head[-2:])
+        head = head[:-2]
+    if head:
+        groups.insert(0, head)
+    return '"' + ','.join(groups + [tail]) + '.' + fraction + '"'
+
+def dataset_path(data_dir, years, tickers, seed):
+    '''
+    :return: path of the generated dataset, generating it on first use
+    '''
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f'stocks_{years}y_{tickers}t_{seed}.csv')
+    if not os.path.exists(path):
+        print(f'Generating {path} ...', file=sys.stderr)
+        generate_dataset(path, years, tickers, seed)
+    return path
+
+def measure(function, repeat):
+    '''
+    Runs function repeat times.
+    :return: dictionary of min, median and max seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return {'min': min(times), 'median': statistics.median(times), 'max': max(times), 'repeat': repeat}
+
+def remove_snapshot(path):
+    for snapshot_path in calculator.PriceStore(path).snapshot_paths():
+        with contextlib.suppress(OSError):
+            os.remove(snapshot_path)
+
+def make_benchmarks(path, lookups):
+    '''
+    :return: list of (name, function, per-call count) pairs; the seconds of a benchmark are divided by its count
+    '''
+    reader = calculator.StockDataReader()
+    store = calculator.PriceStore.shared(path)
+    rng = np.random.default_rng(1)
+
+    date_strings = [f'{day.day:02d}-{day.month:02d}-{day.year}' for day in store.dates.tolist()]
+    sample_dates = [date_strings[i] for i in rng.integers(0, len(date_strings), lookups)]
+    sample_stocks = [store.tickers[i] for i in rng.integers(0, len(store.tickers), lookups)]
+    sample_days = [int(store.days[i]) for i in rng.integers(0, len(store.days), lookups)]
+    year_start = int(store.days[max(len(store.days) - TRADING_DAYS_PER_YEAR, 0)])
+    last_day = int(store.days[-1])
+    stock = store.tickers[0]
+    # best_trades copies its window of every stock, a wide dataset's whole history would be gigabytes of temporaries
+    best_trades_start = year_start if store.lazy else int(store.days[0])
+
+    def csv_parse():
+        calculator.PriceStore(path, use_snapshot=False).load()
+
+    def snapshot_build():
+        remove_snapshot(path)
+        calculator.PriceStore(path).load()
+
+    def snapshot_load():
+        calculator.PriceStore(path).load()
+
+    def date_tuples():
+        for date_string in sample_dates:
+            reader.string_date_into_tuple(date_string)
+
+    def date_column():
+        reader.strings_date_into_days(date_strings)
+
+    def price_lookup():
+        for stock_name, day in zip(sample_stocks, sample_days):
+            store.price(stock_name, day)
+
+    def range_extraction():  # As in LineGraphWindow, one year of one stock
+        for stock_name in sample_stocks:
+            store.range_series(stock_name, year_start, last_day)
+
+    def multi_stock_profit():  # As in GraphWindow, one trade for every stock
+        store.batch_profit(year_start, last_day, 10)
+
+    def best_trades():
+        store.best_trades(best_trades_start, last_day)
+
+    def range_stats():  # High, low, return and drawdown of the window for every stock
+        store.range_stats(year_start, last_day)
+
+    canvas_class = calculator.load_matplotlib_canvas()
+    line_canvas = canvas_class()
+    line_canvas.resize(600, 400)
+    bar_canvas = canvas_class()
+    bar_canvas.resize(600, 400)
+    categories = store.tickers[:19]
+
+    def line_chart_render():
+        dates, prices = store.range_series(stock, int(store.days[0]), last_day)
+        dates, prices = calculator.min_max_decimate(dates, prices, 600)
+        line_canvas.plot_line_graph(stock, dates, prices)
+        line_canvas.draw()
+
+    def bar_chart_render():
+        profits = store.batch_profit(year_start, last_day, 10)['profit'][:len(categories)]
+        bar_canvas.plot_bar_chart(categories, profits.tolist())
+        bar_canvas.draw()
+
+    return [
+        ('csv_parse', csv_parse, 1),
+        ('snapshot_build', snapshot_build, 1),
+        ('snapshot_load', snapshot_load, 1),
+        ('make_data', lambda: reader.make_data(path), 1),
+        ('string_date_into_tuple', date_tuples, len(sample_dates)),
+        ('strings_date_into_days', date_column, 1),
+        ('price_lookup', price_lookup, len(sample_stocks)),
+        ('range_extraction', range_extraction, len(sample_stocks)),
+        ('multi_stock_profit', multi_stock_profit, 1),
+        ('best_trades', best_trades, 1),
+        ('range_stats', range_stats, 1),
+        ('line_chart_render', line_chart_render, 1),
+        ('bar_chart_render', bar_chart_render, 1),
+    ]
+
+def brute_range_stats(prices, first, last):
+    '''
+    High, low, percent return and max drawdown of rows first..last of every column, one column at a time.
+    The return runs from the last price on or before first to the last price on or before last.
+    '''
+    stats = {field: [] for field in calculator.RangeIndex.FIELDS}
+    for column in prices.T.tolist():
+        window = [price for price in column[first:last + 1] if price > 0]
+        before_first = [price for price in column[:first + 1] if price > 0]
+        before_last = [price for price in column[:last + 1] if price > 0]
+        if not window:
+            for field in stats:
+                stats[field].append(np.nan)
+            continue
+        peak, fall = window[0], 0.0
+        for price in window:
+            peak = max(peak, price)
+            fall = max(fall, 1 - price / peak)
+        stats['high'].append(max(window))
+        stats['low'].append(min(window))
+        stats['percent_return'].append((before_last[-1] / before_first[-1] - 1) * 100 if before_first else np.nan)
+        stats['max_drawdown'].append(fall * 100)
+    return {field: np.array(values) for field, values in stats.items()}
+
+def check_range_stats(store, windows, seed=0):
+    '''
+    Compares the RangeIndex and the window scan with brute_range_stats on random windows, on a copy of the store where
+    some stocks start late, stop early and have gaps, since the generated data has a price on every day.
+    :return: list of mismatch descriptions, empty if all agree
+    '''
+    rng = np.random.default_rng(seed)
+    tickers = store.tickers[:64]
+    prices = np.array(store.prices[:, :len(tickers)])
+    rows = len(prices)
+    prices[:rows // 3, 0] = 0.0  # Listed late
+    prices[-rows // 4:, 1 % len(tickers)] = 0.0  # Delisted
+    prices[rng.random(prices.shape) < 0.05] = 0.0  # Gaps
+
+    checked = calculator.PriceStore(store.path)
+    checked.set_arrays(tickers, np.array(store.days), prices)
+    checked.index_ranges()
+    if checked.range_index is None:
+        return ['the range index was not built for the check']
+
+    mismatches = []
+    for _ in range(windows):
+        first, last = sorted(rng.integers(0, rows, 2).tolist())
+        expected = brute_range_stats(prices, first, last)
+        for name, stats in (('index', checked.range_index.query(first, last)),
+                            ('scan', checked.scan_range_stats(first, last, list(range(len(tickers))), block_columns=7))):
+            for field, values in stats.items():
+                if not np.allclose(values, expected[field], rtol=1e-9, atol=1e-9, equal_nan=True):
+                    mismatches.append(f"{name} {field} rows {first}..{last}: {values.tolist()} != {expected[field].tolist()}")
+    return mismatches
+
+def write_rows(file, days, prices):
+    for row, day in enumerate(days.astype('datetime64[D]').tolist()):
+        date = f'{day.day}/{day.month}/{day.year}' if row % 2 else f'{day.day:02d}-{day.month:02d}-{day.year}'
+        file.write(date + ',' + ','.join(format_price(price) for price in prices[row].tolist()) + '\n')
+
+def check_loads(store, data_dir):
+    '''
+    Writes a small CSV from the store, appends newer rows and a correction of a day already in the file to it,
+    and the start of a row still being written, and compares the arrays of incremental ingest, a snapshot reload and a full parse, for narrow and lazy stores.
+    :return: list of mismatch descriptions, empty if all agree
+    '''
+    path = os.path.join(data_dir, 'check_loads.csv')
+    tickers = store.tickers[:16]
+    days = np.array(store.days[-300:])
+    prices = np.array(store.prices[-300:, :len(tickers)])
+    correction = prices[100:101] + 1.0  # The feed sends a day again with new prices
+
+    mismatches = []
+    for lazy in (False, True):
+        remove_snapshot(path)
+        with open(path, mode='w') as file:
+            file.write('Date,' + ','.join(tickers) + '\n')
+            write_rows(file, days[:250][::-1], prices[:250][::-1])  # Newest first
+        live = calculator.PriceStore(path, lazy_columns=lazy)
+        live.refresh()
+        with open(path, mode='a') as file:
+            write_rows(file, days[250:][::-1], prices[250:][::-1])
+            write_rows(file, days[100:101], correction)
+            file.write('05-02-2030,1')  # A row the feed is still writing, no load may take it
+        live.refresh()
+
+        loads = {'incremental': live,
+                 'snapshot': calculator.PriceStore(path, lazy_columns=lazy).load(),
+                 'parse': calculator.PriceStore(path, use_snapshot=False).load()}
+        expected_prices = prices.copy()
+        expected_prices[100] = correction
+        for name, loaded in loads.items():
+            kind = f"{'lazy' if lazy else 'narrow'} {name}"
+            if not np.array_equal(loaded.days, days):
+                mismatches.append(f"{kind}: {len(loaded.days)} days, expected {len(days)}")
+            elif not np.array_equal(np.array(loaded.prices), expected_prices):
+                mismatches.append(f"{kind}: prices differ")
+            elif loaded.date_index != {day: row for row, day in enumerate(days.tolist())}:
+                mismatches.append(f"{kind}: date_index differs from the rows")
+    remove_snapshot(path)
+    os.remove(path)
+    return mismatches
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    '''
+    Prints how every benchmark changed against an earlier results file, by median.
+    '''
+    with open(baseline_path, mode='r') as file:
+        baseline = json.load(file)['results']
+    print(f"{'benchmark':<24}{'before':>14}{'after':>14}{'change':>10}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['median']
+        after = result['median']
+        print(f"{name:<24}{before:>14.6g}{after:>14.6g}{(after / before - 1) * 100 if before else 0:>+9.1f}%")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stock trade calculator on synthetic data.')
+    parser.add_argument('--preset', choices=sorted(PRESETS), help='dataset size, overrides --years and --tickers')
+    parser.add_argument('--years', type=int, default=4, help='years of weekday rows')
+    parser.add_argument('--tickers', type=int, default=19, help='stock columns')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default='bench_data', help='where generated datasets are kept between runs')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark')
+    parser.add_argument('--lookups', type=int, default=10000, help='calls per run of the lookup benchmarks')
+    parser.add_argument('--only', nargs='+', metavar='NAME', help='run only these benchmarks')
+    parser.add_argument('--skip', nargs='+', metavar='NAME', default=[], help='skip these benchmarks, e.g. make_data on huge datasets')
+    parser.add_argument('-o', '--output', help='JSON results file, standard output if omitted')
+    parser.add_argument('--compare', metavar='JSON', help='earlier results file to compare against')
+    parser.add_argument('--check', type=int, nargs='?', const=200, metavar='WINDOWS',
+                        help='first compare the range statistics with a brute-force calculation on random windows and the arrays of '
+                             'the different load paths, exit 1 on a mismatch')
+    args = parser.parse_args(argv)
+
+    years, tickers = PRESETS[args.preset] if args.preset else (args.years, args.tickers)
+    path = dataset_path(args.data_dir, years, tickers, args.seed)
+    skip = set(args.skip)
+    if tickers > calculator.PriceStore.WIDE_UNIVERSE_TICKERS:
+        wide_skips = [name for name in IN_MEMORY_BENCHMARKS if not args.only and name not in skip]
+        if wide_skips:
+            print(f"Skipping {', '.join(wide_skips)} on a wide dataset, name them in --only to run them anyway", file=sys.stderr)
+        skip.update(wide_skips)
+    app = calculator.QApplication.instance() or calculator.QApplication([])
+
+    if args.check:
+        with contextlib.redirect_stdout(sys.stderr):
+            mismatches = check_range_stats(calculator.PriceStore.shared(path), args.check, args.seed)
+            load_mismatches = check_loads(calculator.PriceStore.shared(path), args.data_dir)
+        for mismatch in (mismatches + load_mismatches)[:20]:
+            print(mismatch, file=sys.stderr)
+        print(f"Range statistics check: {len(mismatches)} mismatches in {args.check} windows", file=sys.stderr)
+        print(f"Load check: {len(load_mismatches)} mismatches between incremental ingest, snapshot reload and full parse", file=sys.stderr)
+        if mismatches or load_mismatches:
+            return 1
+
+    results = {}
+    with contextlib.redirect_stdout(sys.stderr):  # Loader messages must not end up in the JSON
+        for name, function, count in make_benchmarks(path, args.lookups):
+            if (args.only and name not in args.only) or name in skip:
+                continue
+            result = measure(function, args.repeat)
+            if count > 1:
+                result = {key: value / count if key != 'repeat' else value for key, value in result.items()}
+                result['per_call'] = True
+            results[name] = result
+            print(f"{name:<24}{result['median']:.6g}s", file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'dataset': {'years': years, 'tickers': tickers, 'rows': years * TRADING_DAYS_PER_YEAR, 'bytes': os.path.getsize(path)},
+        'skipped': sorted(skip),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, mode='w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+    del app
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
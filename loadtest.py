@@ -0,0 +1,174 @@
+'''
+Latency and throughput load test for the query server (python StockTradeCalculator.py serve).
+
+Clients keep their connections open and send a mix of price, series and profit queries drawn from a fixed pool,
+so the share of repeated queries (and the hit rate of the response cache) follows from --distinct:
+
+    python loadtest.py --spawn --requests 20000 --concurrency 64
+    python loadtest.py --url http://127.0.0.1:8765 --duration 30 -o load.json
+'''
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import subprocess
+import urllib.parse
+
+import numpy as np
+
+MIX = {'price': 0.6, 'series': 0.1, 'profit': 0.3}
+
+async def get(reader, writer, host, target):
+    '''
+    One GET on a keep-alive connection.
+    :return: (status, body bytes)
+    '''
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+def make_queries(stocks, dates, distinct, seed=0):
+    '''
+    :return: list of (kind, target) queries with valid stocks and dates
+    '''
+    rng = random.Random(seed)
+    kinds, weights = zip(*MIX.items())
+    queries = []
+    for _ in range(distinct):
+        kind = rng.choices(kinds, weights)[0]
+        stock = rng.choice(stocks)
+        first, last = sorted(rng.sample(range(len(dates)), 2))
+        if kind == 'price':
+            params = {'stock': stock, 'date': dates[first]}
+        elif kind == 'series':
+            params = {'stock': stock, 'start': dates[first], 'end': dates[last], 'points': 600}
+        else:
+            params = {'buy': dates[first], 'sell': dates[last], 'quantity': rng.randint(1, 100)}
+        queries.append((kind, f"/{kind}?{urllib.parse.urlencode(params)}"))
+    return queries
+
+async def client(host, port, queries, rng, deadline, budget, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline and budget[0] > 0:
+            budget[0] -= 1
+            kind, target = rng.choice(queries)
+            started = time.perf_counter()
+            status, _ = await get(reader, writer, host, target)
+            latencies[kind].append(time.perf_counter() - started)
+            if status != 200:
+                errors[status] = errors.get(status, 0) + 1
+    finally:
+        writer.close()
+
+def summarize(seconds):
+    seconds = np.sort(np.asarray(seconds)) * 1000
+    if len(seconds) == 0:
+        return {'count': 0}
+    return {'count': len(seconds), 'mean_ms': float(seconds.mean()), 'p50_ms': float(np.percentile(seconds, 50)),
+            'p90_ms': float(np.percentile(seconds, 90)), 'p99_ms': float(np.percentile(seconds, 99)), 'max_ms': float(seconds[-1])}
+
+async def run(host, port, args):
+    reader, writer = await asyncio.open_connection(host, port)
+    _, body = await get(reader, writer, host, '/stocks')
+    stocks = json.loads(body)['stocks']
+    _, body = await get(reader, writer, host, '/series?' + urllib.parse.urlencode({'stock': stocks[0], 'start': '1900-01-01', 'end': '2999-12-31'}))
+    dates = json.loads(body)['dates']
+    writer.close()
+
+    queries = make_queries(stocks, dates, args.distinct, args.seed)
+    latencies = {kind: [] for kind in MIX}
+    errors = {}
+    budget = [args.requests]
+    started = time.perf_counter()
+    deadline = started + args.duration if args.duration else float('inf')
+    await asyncio.gather(*(client(host, port, queries, random.Random(args.seed + i), deadline, budget, latencies, errors)
+                           for i in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, body = await get(reader, writer, host, '/stats')
+    writer.close()
+    counters = json.loads(body)['counters']
+
+    total = sum(len(values) for values in latencies.values())
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'concurrency': args.concurrency,
+        'distinct_queries': args.distinct,
+        'requests': total,
+        'seconds': elapsed,
+        'requests_per_second': total / elapsed,
+        'latency': dict({'all': summarize([value for values in latencies.values() for value in values])},
+                        **{kind: summarize(values) for kind, values in latencies.items()}),
+        'errors': errors,
+        'server_cache_hit': counters.get('response_cache_hit', 0),
+        'server_cache_miss': counters.get('response_cache_miss', 0),
+    }
+
+def wait_for_server(host, port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('the server exited')
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('the server did not start')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the stock query server.')
+    parser.add_argument('--url', default='http://127.0.0.1:8765', help='server to test')
+    parser.add_argument('--spawn', action='store_true', help='start a server on the --url port for the test and stop it after')
+    parser.add_argument('--data', help='stock market CSV for --spawn')
+    parser.add_argument('--concurrency', type=int, default=32, help='clients, each with one keep-alive connection')
+    parser.add_argument('--requests', type=int, default=10000, help='requests in total')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds instead')
+    parser.add_argument('--distinct', type=int, default=2000, help='size of the query pool; smaller means more cache hits')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='JSON results file, standard output if omitted')
+    args = parser.parse_args(argv)
+    if args.duration:
+        args.requests = sys.maxsize
+
+    url = urllib.parse.urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    server = None
+    if args.spawn:
+        command = [sys.executable, 'StockTradeCalculator.py', 'serve', '--host', host, '--port', str(port)]
+        server = subprocess.Popen(command + (['--data', args.data] if args.data else []), stderr=subprocess.DEVNULL)
+    try:
+        if server is not None:
+            wait_for_server(host, port, server)
+        report = asyncio.run(run(host, port, args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latency = report['latency']['all']
+    print(f"{report['requests']} requests in {report['seconds']:.2f}s: {report['requests_per_second']:,.0f} req/s, "
+          f"p50 {latency['p50_ms']:.2f}ms, p99 {latency['p99_ms']:.2f}ms", file=sys.stderr)
+    if args.output:
+        with open(args.output, mode='w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())